@@ -1,11 +1,13 @@
 var divvyStats = {};
+var divvySections = {};
 
 
 subtitles = [];
 
 
 async function fetchDivvyStats() {
-    let resp = await fetch("/divvy-stats.json");
+    // The manifest keeps its name between runs, so always revalidate it
+    let resp = await fetch("/divvy-stats.json", { cache: "no-cache" });
     divvyStats = await resp.json();
 
     subtitles = [`Data Month: ${divvyStats.meta.as_of}`]
@@ -13,6 +15,18 @@ async function fetchDivvyStats() {
 }
 
 
+function loadDivvySection(name) {
+    // Section files are named by content hash, so any cached copy is current
+    if (!divvySections[name]) {
+        divvySections[name] = fetch(divvyStats.sections[name], { cache: "force-cache" })
+            .then(resp => resp.json())
+            .then(section => divvyStats.stats[name] = section);
+    }
+
+    return divvySections[name];
+}
+
+
 function getStatItemByKeyValue(statName, key, value) {
     if (!divvyStats || !divvyStats.stats[statName]) {
         return;
@@ -70,7 +84,29 @@ function loadStats() {
     loadRevenueStats();
     loadTimeOfDayStats();
     loadStationEfficiency();
-    createNeighborhoodMap();
+    loadNeighborhoodMapOnDemand();
+}
+
+
+function loadNeighborhoodMapOnDemand() {
+    let load = () => Promise.all([
+        loadDivvySection("neighborhood_stations"),
+        loadDivvySection("neighborhood_map")
+    ]).then(createNeighborhoodMap);
+
+    if (!("IntersectionObserver" in window)) {
+        load();
+        return;
+    }
+
+    // Only fetch the map sections once the map is about to scroll into view
+    let observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            observer.disconnect();
+            load();
+        }
+    }, { rootMargin: "200px" });
+    observer.observe(document.getElementById("neighborhood-map-container"));
 }
 
 
@@ -195,8 +231,66 @@ function createPeakHoursChart(peakHours, container) {
 }
 
 
+function decodeTopologyArcs(topology) {
+    // Arcs are delta-encoded integer points
+    return topology.arcs.map(arc => {
+        let x = 0, y = 0;
+        return arc.map(([dx, dy]) => [x += dx, y += dy]);
+    });
+}
+
+
+function topologyRingToPath(ring, arcs) {
+    let points = [];
+    ring.forEach(index => {
+        // Negative indexes (~i) reference arc i traversed in reverse
+        let arc = index < 0 ? arcs[~index].slice().reverse() : arcs[index];
+        // Consecutive arcs share their joining point
+        points.push(...(points.length ? arc.slice(1) : arc));
+    });
+    return "M " + points.map(p => `${p[0]} ${p[1]}`).join(" L ") + " Z";
+}
+
+
+function buildNeighborhoodSvg(topology, stationData) {
+    const arcs = decodeTopologyArcs(topology);
+    const [width, height] = topology.size;
+
+    let svgParts = [];
+    svgParts.push(
+        `<svg width="800" height="600" viewBox="0 0 ${width} ${height}" ` +
+        'xmlns="http://www.w3.org/2000/svg">'
+    );
+    svgParts.push('<defs>');
+    svgParts.push('<style>');
+    svgParts.push('.neighborhood { fill: #1a1a1a; fill-rule: evenodd; stroke: #63a4ff; stroke-width: 1; cursor: pointer; }');
+    svgParts.push('.neighborhood:hover { fill: #2a2a2a; }');
+    svgParts.push('.neighborhood.active { fill: #63a4ff; }');
+    svgParts.push('.neighborhood-label { font-family: monospace; font-size: 8px; fill: #9c9c9c; pointer-events: none; }');
+    svgParts.push('</style>');
+    svgParts.push('</defs>');
+
+    topology.objects.neighborhoods.geometries.forEach(geometry => {
+        const name = geometry.properties.name;
+        const pathData = geometry.arcs
+            .map(polygon => polygon.map(ring => topologyRingToPath(ring, arcs)).join(" "))
+            .join(" ");
+        svgParts.push(`<path class="neighborhood" d="${pathData}" data-neighborhood="${name}"/>`);
+
+        // Add label for neighborhoods with activity
+        if (stationData[name] && stationData[name].total_rides > 0) {
+            const [x, y] = geometry.properties.label;
+            svgParts.push(`<text x="${x}" y="${y}" class="neighborhood-label" text-anchor="middle">${name}</text>`);
+        }
+    });
+    svgParts.push('</svg>');
+
+    return svgParts.join("\n");
+}
+
+
 function createNeighborhoodMap() {
-    if (!divvyStats.stats.neighborhood_stations || !divvyStats.stats.neighborhood_svg_map) return;
+    if (!divvyStats.stats.neighborhood_stations || !divvyStats.stats.neighborhood_map) return;
     
     let mapContainer = document.getElementById("neighborhood-map");
     let detailsContainer = document.getElementById("neighborhood-details");
@@ -205,14 +299,15 @@ function createNeighborhoodMap() {
     let neighborhoodStats = document.getElementById("neighborhood-stats");
     let stationsList = document.getElementById("neighborhood-stations-list");
     
+    const stationData = divvyStats.stats.neighborhood_stations;
+
     // Insert the SVG map
-    mapContainer.innerHTML = divvyStats.stats.neighborhood_svg_map;
+    mapContainer.innerHTML = buildNeighborhoodSvg(divvyStats.stats.neighborhood_map, stationData);
     mapContainer.classList.remove("hidden");
     detailsContainer.classList.add("hidden");
 
     // --- HEATMAP COLORING ---
     // Get all ride_percent values for normalization
-    const stationData = divvyStats.stats.neighborhood_stations;
     const ridePercents = Object.values(stationData).map(n => n.ride_percent || 0);
     const minPercent = Math.min(...ridePercents);
     const maxPercent = Math.max(...ridePercents);
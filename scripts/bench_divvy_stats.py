@@ -0,0 +1,374 @@
+#!/usr/bin/env uv run --script
+# /// script
+# requires-python = ">=3.11,<3.12"
+# dependencies = [
+#   "brotli==1.1.0",
+#   "duckdb==1.3.2",
+#   "geopandas==1.1.1",
+#   "numpy==2.3.2",
+#   "pandas==2.3.2",
+#   "pyarrow==21.0.0",
+#   "requests==2.32.5",
+#   "shapely==2.1.1"
+# ]
+# ///
+"""Benchmark the Divvy stats pipeline on deterministic synthetic months
+
+Runs offline: trips are generated from a seed and neighborhoods come from the
+shapefile bundled next to this script. Each stage is measured with the
+pipeline's own StageProfiler: ingest, feature engineering, neighborhood
+assignment, every aggregate table, every stat's formatter, and writing the
+compressed output. Results are compared against a stored baseline.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import sys
+from typing import Iterator
+import zipfile
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import fetch_divvy_stats as divvy
+
+
+BENCH_DIR = Path(".divvy_bench")
+DATA_DIR = BENCH_DIR / "data"
+SHAPEFILE_ZIP = Path(__file__).parent / "Neighborhoods_2012b_20241217.zip"
+DEFAULT_ROWS = [100_000, 1_000_000, 10_000_000]
+# Bump whenever generate_trips changes, so stale generated months are not reused
+GENERATOR_VERSION = 3
+GENERATOR_CHUNK_ROWS = 500_000
+BENCH_MONTH = "202407"
+STATION_COUNT = 1_500
+# Station popularity falls off as 1 / rank**STATION_POPULARITY_EXPONENT, so
+# the busiest station takes about 6% of trips rather than most of them
+STATION_POPULARITY_EXPONENT = 0.8
+# Stages faster than this are too noisy to flag as regressions
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def generate_stations(rng: np.random.Generator, shapefile_fp: Path) -> pd.DataFrame:
+    """Stations placed uniformly inside the neighborhoods, busiest first"""
+    _, _, tree = divvy.load_neighborhood_polygons(shapefile_fp)
+    lng_min, lat_min, lng_max, lat_max = shapely.total_bounds(tree.geometries)
+
+    lat, lng = np.empty(0), np.empty(0)
+    while len(lat) < STATION_COUNT:
+        candidate_lat = rng.uniform(lat_min, lat_max, STATION_COUNT)
+        candidate_lng = rng.uniform(lng_min, lng_max, STATION_COUNT)
+        inside, _ = tree.query(
+            shapely.points(candidate_lng, candidate_lat), predicate="within"
+        )
+        inside = np.unique(inside)
+        lat = np.concatenate([lat, candidate_lat[inside]])
+        lng = np.concatenate([lng, candidate_lng[inside]])
+
+    popularity = 1 / np.arange(1, STATION_COUNT + 1) ** STATION_POPULARITY_EXPONENT
+    return pd.DataFrame(
+        {
+            "name": [f"Synthetic Ave & {i} St" for i in range(STATION_COUNT)],
+            "id": [f"SY{i:05d}" for i in range(STATION_COUNT)],
+            "lat": lat[:STATION_COUNT],
+            "lng": lng[:STATION_COUNT],
+            "weight": popularity / popularity.sum(),
+        }
+    )
+
+
+def generate_trips(
+    rows: int, seed: int, shapefile_fp: Path, month: str = BENCH_MONTH
+) -> Iterator[pd.DataFrame]:
+    """Divvy shaped trips, identical for the same rows and seed
+
+    Station popularity is heavy tailed, e-bikes and scooters are often dockless
+    (no station, coordinates rounded to two decimals like Divvy's), and a few
+    trips are missing their end or their start time, as in the published data.
+    """
+    rng = np.random.default_rng(seed)
+    stations = generate_stations(rng, shapefile_fp)
+    month_start = np.datetime64(f"{month[:4]}-{month[4:]}-01T00:00:00", "ms")
+    month_ms = 30 * 24 * 60 * 60 * 1000
+
+    for offset in range(0, rows, GENERATOR_CHUNK_ROWS):
+        n = min(GENERATOR_CHUNK_ROWS, rows - offset)
+        rideable_type = rng.choice(
+            ["classic_bike", "electric_bike", "electric_scooter"], n, p=[0.45, 0.5, 0.05]
+        )
+        starts = rng.choice(STATION_COUNT, n, p=stations["weight"])
+        ends = rng.choice(STATION_COUNT, n, p=stations["weight"])
+        docked_start = (rideable_type == "classic_bike") | (rng.random(n) < 0.6)
+        docked_end = (rideable_type == "classic_bike") | (rng.random(n) < 0.6)
+
+        started_at = month_start + rng.integers(0, month_ms, n).astype("timedelta64[ms]")
+        duration = rng.lognormal(np.log(11 * 60 * 1000), 0.8, n).astype("timedelta64[ms]")
+
+        trips = {
+            "ride_id": [f"{value:016X}" for value in rng.integers(0, 2**62, n)],
+            "rideable_type": rideable_type,
+            "started_at": np.datetime_as_string(started_at),
+            "ended_at": np.datetime_as_string(started_at + duration),
+        }
+        for end, station, docked in (
+            ("start", starts, docked_start),
+            ("end", ends, docked_end),
+        ):
+            trips[f"{end}_station_name"] = np.where(
+                docked, stations["name"].to_numpy()[station], None
+            )
+            trips[f"{end}_station_id"] = np.where(
+                docked, stations["id"].to_numpy()[station], None
+            )
+            for axis in ("lat", "lng"):
+                exact = stations[axis].to_numpy()[station]
+                dockless = np.round(exact + rng.normal(0, 0.004, n), 2)
+                trips[f"{end}_{axis}"] = np.where(docked, exact, dockless)
+
+        trips["member_casual"] = rng.choice(["member", "casual"], n, p=[0.64, 0.36])
+        df = pd.DataFrame(trips)
+        df.loc[rng.random(n) < 0.001, ["end_lat", "end_lng"]] = np.nan
+        # Ingest coerces these to NaT
+        df.loc[rng.random(n) < 0.0001, "started_at"] = ""
+        yield df
+
+
+def get_synthetic_month(rows: int, seed: int) -> Path:
+    """Zip of a generated month laid out like Divvy's archives, generated once"""
+    name = f"{BENCH_MONTH}-divvy-tripdata"
+    fp = DATA_DIR / f"{name}.{rows}.{seed}.g{GENERATOR_VERSION}.zip"
+    if fp.is_file():
+        return fp
+
+    print(f"Generating {rows:,} synthetic trips...")
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_fp = fp.with_suffix(".part")
+    with zipfile.ZipFile(tmp_fp, "w", zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(f"{name}.csv", "w", force_zip64=True) as member:
+            with io.TextIOWrapper(member, encoding="utf-8", newline="") as text:
+                for i, chunk in enumerate(generate_trips(rows, seed, get_shapefile())):
+                    chunk.to_csv(text, index=False, header=i == 0)
+
+    tmp_fp.rename(fp)
+    return fp
+
+
+def get_shapefile() -> Path:
+    """The bundled neighborhood shapefile, extracted once"""
+    shapefile_dir = BENCH_DIR / "shapefile"
+    if not shapefile_dir.is_dir():
+        with zipfile.ZipFile(SHAPEFILE_ZIP) as zf:
+            zf.extractall(shapefile_dir)
+
+    return next(shapefile_dir.glob("*.shp")).resolve()
+
+
+@contextlib.contextmanager
+def bench_stage(
+    profiler: divvy.StageProfiler, name: str, rows: int
+) -> Iterator[divvy.StageRecord]:
+    # Garbage from the previous stage should not count toward this one's RSS
+    gc.collect()
+    with profiler.stage(name) as record:
+        record.rows = rows
+        yield record
+
+
+def find_engine_mismatches(engine_aggregates: dict[str, dict]) -> list[str]:
+    """Stats the engines publish differently; they should all be byte-identical"""
+    rendered = [
+        {stat.name: json.dumps(stat.format(aggregates)) for stat in divvy.STATS}
+        for aggregates in engine_aggregates.values()
+    ]
+    return [
+        name
+        for name in rendered[0]
+        if any(other[name] != rendered[0][name] for other in rendered[1:])
+    ]
+
+
+def run_benchmark(
+    rows: int, seed: int, engines: list[str], verbose: bool = False
+) -> dict:
+    """Time every stage of one month through the pipeline, from a cold cache
+
+    When more than one engine runs, their stats must match exactly.
+    """
+    zip_fp = get_synthetic_month(rows, seed).resolve()
+    shapefile_fp = get_shapefile()
+
+    run_dir = BENCH_DIR / f"run-{rows}"
+    shutil.rmtree(run_dir, ignore_errors=True)
+    run_dir.mkdir(parents=True)
+    cwd = Path.cwd()
+    os.chdir(run_dir)
+
+    print(f"Benchmarking {rows:,} trips...")
+    profiler = divvy.StageProfiler()
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    engine_aggregates = {}
+    try:
+        with quiet:
+            with bench_stage(profiler, "ingest", rows):
+                divvy.ingest_zipfile_to_trip_store(zip_fp, BENCH_MONTH, "bench")
+
+            if "pandas" in engines:
+                with bench_stage(profiler, "read", rows):
+                    df = divvy.read_trips_from_store([BENCH_MONTH], divvy.ANALYSIS_COLUMNS)
+                with bench_stage(profiler, "features", rows):
+                    df = divvy.derive_trip_features(df)
+                with bench_stage(profiler, "neighborhoods", rows):
+                    df = divvy.get_neighborhoods(df, shapefile_fp)
+                gc.collect()
+                aggregates = divvy.compute_month_aggregates(df, profiler=profiler)
+                engine_aggregates["pandas"] = aggregates
+                del df
+
+            # Grid cells the pandas engine resolved are already in the
+            # neighborhood index, so this engine's lookup runs warm
+            if "duckdb" in engines:
+                gc.collect()
+                aggregates = divvy.compute_month_aggregates_sql(
+                    BENCH_MONTH, shapefile_fp, profiler=profiler
+                )
+                engine_aggregates["duckdb"] = aggregates
+
+            result = {"meta": {"as_of": BENCH_MONTH, "months": [BENCH_MONTH]}, "stats": {}}
+            for stat in divvy.STATS:
+                with bench_stage(profiler, f"format {stat.name}", rows):
+                    result["stats"][stat.name] = stat.format(aggregates)
+            with bench_stage(profiler, "format neighborhood_map", rows):
+                result["stats"]["neighborhood_map"] = divvy.get_neighborhood_map(
+                    shapefile_fp
+                )
+            with bench_stage(profiler, "write", rows):
+                divvy.write_stats_output(result)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    profiler.print_summary()
+    mismatches = find_engine_mismatches(engine_aggregates)
+    if mismatches:
+        raise Exception(f"Engines disagree on {', '.join(mismatches)}")
+
+    return {record.name: record.to_json() for record in profiler.records}
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Stages that got slower or used more memory than the baseline allows"""
+    regressions = []
+    for rows, stages in results.items():
+        for stage, current in stages.items():
+            previous = baseline.get(rows, {}).get(stage)
+            if previous is None:
+                continue
+
+            if (
+                current["wall_seconds"] > previous["wall_seconds"] * (1 + tolerance)
+                and current["wall_seconds"] - previous["wall_seconds"]
+                > MIN_REGRESSION_SECONDS
+            ):
+                regressions.append(
+                    f"{rows} rows, {stage}: {current['wall_seconds']:.2f}s "
+                    f"(baseline {previous['wall_seconds']:.2f}s)"
+                )
+            if current["peak_rss_mb"] > previous["peak_rss_mb"] * (1 + tolerance):
+                regressions.append(
+                    f"{rows} rows, {stage}: {current['peak_rss_mb']:.0f} MB peak RSS "
+                    f"(baseline {previous['peak_rss_mb']:.0f} MB)"
+                )
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark fetch_divvy_stats.py on synthetic trip data"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=DEFAULT_ROWS,
+        help="sizes of the synthetic months to benchmark",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the trip generator")
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["pandas", "duckdb"],
+        default=["pandas"],
+        help="aggregation engines to benchmark",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=BENCH_DIR / "baseline.json",
+        help="results to compare against",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store these results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction a stage may exceed its baseline by before it is flagged",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=BENCH_DIR / "results.json",
+        help="where to write the results",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the pipeline's own output"
+    )
+    args = parser.parse_args()
+
+    results = {
+        str(rows): run_benchmark(rows, args.seed, args.engines, args.verbose)
+        for rows in args.rows
+    }
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "results": results,
+    }
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Wrote results to {args.output}")
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not args.baseline.is_file():
+        print("No baseline to compare against; run with --save-baseline to store one")
+        return
+
+    baseline = json.loads(args.baseline.read_text())["results"]
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if regressions:
+        sys.exit(1)
+
+    print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
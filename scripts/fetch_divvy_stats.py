@@ -2,180 +2,1270 @@
 # /// script
 # requires-python = ">=3.11,<3.12"
 # dependencies = [
+#   "brotli==1.1.0",
+#   "duckdb==1.3.2",
 #   "geopandas==1.1.1",
+#   "numpy==2.3.2",
 #   "pandas==2.3.2",
-#   "requests==2.32.5"
+#   "pyarrow==21.0.0",
+#   "requests==2.32.5",
+#   "shapely==2.1.1"
 # ]
 # ///
+import argparse
+import base64
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import cProfile
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
-import io
+import functools
+import gzip
+import hashlib
 import json
+import math
+import multiprocessing
+import os
 from pathlib import Path
+import pstats
 import re
-import sqlite3
-from typing import Optional, Union, Any
+import resource
+import shutil
+import sys
+from typing import Callable, Iterator, Optional, Union, Any
+import tracemalloc
 import xml.etree.ElementTree as ET
 import zipfile
 import time
 
-import geopandas as gpd
+import brotli
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 import requests
+import shapely
 
 
 DIVVY_BUCKET_NAME = "divvy-tripdata"
-DIVVY_TABLE_NAME = "trips"
-NEIGHBORHOOD_SHAPEFILE_LINK = "https://github.com/tylergibbs2/tyler.solutions/raw/refs/heads/master/scripts/Neighborhoods_2012b_20241217.zip"
+DIVVY_BUCKET_URL = f"https://{DIVVY_BUCKET_NAME}.s3.amazonaws.com"
+# Monthly archives are keyed YYYYMM-..., so listing under the century skips
+# the older yearly and quarterly archives
+MONTHLY_KEY_PREFIX = "20"
+NEIGHBORHOOD_SHAPEFILE_ZIP = Path(__file__).parent / "Neighborhoods_2012b_20241217.zip"
 FILENAME_PATTERN = re.compile(r"\d{6}-divvy-tripdata\.zip")
 OUTFILE_NAME = "divvy-stats.json"
+# Committed next to the stats, so its history shows regressions between runs
+PROFILE_FP = Path("divvy-stats.profile.json")
+STATS_SECTION_DIR = Path("divvy-stats")
+# Stats too large for the manifest, which the page loads on demand
+SPLIT_SECTIONS = [
+    "neighborhood_stations",
+    "neighborhood_map",
+    "station_flows",
+    "rollup_cube",
+    "trip_density",
+    "neighborhood_flows",
+]
+# Brotli's top quality costs seconds per large section for a few percent
+BROTLI_QUALITY = 11
+BROTLI_LARGE_QUALITY = 9
+BROTLI_LARGE_BYTES = 256 * 1024
+CACHE_DIR = Path(".divvy_cache")
+DOWNLOAD_DIR = CACHE_DIR / "downloads"
+SHAPEFILE_DIR = CACHE_DIR / "shapefiles"
+TRIP_STORE_DIR = CACHE_DIR / "trips"
+CHECKPOINT_DIR = CACHE_DIR / "checkpoints"
+NEIGHBORHOOD_INDEX_DIR = CACHE_DIR / "neighborhoods"
+MAP_CACHE_DIR = CACHE_DIR / "maps"
+PROFILE_DIR = CACHE_DIR / "profile"
+BUCKET_MANIFEST_FP = CACHE_DIR / "bucket_manifest.json"
+# Bump whenever the layout or meaning of the cached month aggregates changes
+AGGREGATE_VERSION = 11
+# Bump whenever the enriched trip columns, or the published JSON, change
+ENRICH_VERSION = 6
+RENDER_VERSION = 7
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_ATTEMPTS = 4
+INGEST_CHUNK_ROWS = 250_000
+# Neighborhoods are resolved per grid cell of 10**-NEIGHBORHOOD_GRID_PRECISION
+# degrees; points in cells on a boundary are tested at COORDINATE_PRECISION
+NEIGHBORHOOD_GRID_PRECISION = 4
+COORDINATE_PRECISION = 6
+NO_NEIGHBORHOOD = -1
+BOUNDARY_CELL = -2
+# Map vertices are snapped to a MAP_QUANTIZATION wide integer grid, then arcs
+# are simplified with a tolerance in grid units
+MAP_QUANTIZATION = 10_000
+MAP_SIMPLIFY_TOLERANCE = 1.5
+# Trip ends are counted on square Web Mercator cells of DENSITY_CELL_METERS;
+# a cell's id packs its row and column on the grid spanning the whole world
+WEB_MERCATOR_RADIUS = 6_378_137
+WEB_MERCATOR_HALF_WIDTH = math.pi * WEB_MERCATOR_RADIUS
+DENSITY_CELL_METERS = 250
+DENSITY_GRID_COLUMNS = math.ceil(2 * WEB_MERCATOR_HALF_WIDTH / DENSITY_CELL_METERS)
+# Streaming mode keeps route counts in bounded memory: a Space-Saving summary
+# of the HEAVY_HITTER_CAPACITY heaviest routes, and a Count-Min sketch that
+# bounds the count of any route by about e / COUNT_MIN_WIDTH of all trips
+HEAVY_HITTER_CAPACITY = 4096
+COUNT_MIN_WIDTH = 1 << 14
+COUNT_MIN_DEPTH = 4
+# Duration and revenue quantiles come from log-bucketed counts (as in DDSketch):
+# every quantile is within QUANTILE_RELATIVE_ACCURACY of the true value, and
+# bucket counts add up across chunks and months like any other count
+QUANTILE_RELATIVE_ACCURACY = 0.01
+QUANTILE_GAMMA = (1 + QUANTILE_RELATIVE_ACCURACY) / (1 - QUANTILE_RELATIVE_ACCURACY)
+QUANTILES = [0.5, 0.9, 0.99]
+# Bucket of zero and negative values, below every log bucket
+ZERO_BUCKET = -(2**15)
+# Lower edges of the published histogram bins; the last bin is open ended
+DURATION_HISTOGRAM_EDGES = [0, 5, 10, 15, 20, 30, 45, 60, 90, 120]
+REVENUE_HISTOGRAM_EDGES = [0, 100, 200, 300, 500, 1000, 2000]
+DISTANCE_HISTOGRAM_EDGES = [0, 500, 1000, 2000, 3000, 5000, 8000, 12000]
+SPEED_HISTOGRAM_EDGES = [0, 4, 8, 12, 16, 20, 25, 30]
+# Distances are straight lines (haversine) between a trip's ends. Trips faster
+# than IMPLAUSIBLE_SPEED_KMH, or ending where they started after more than
+# IMPLAUSIBLE_STATIONARY_MINUTES, are flagged and left out of both histograms
+EARTH_RADIUS_METERS = 6_371_008.8
+IMPLAUSIBLE_SPEED_KMH = 45
+IMPLAUSIBLE_STATIONARY_MINUTES = 180
+# Station arrivals and departures are binned into slots of the day, and the
+# stations with the deepest intraday inventory deficits are published
+STATION_FLOW_SLOT_MINUTES = 15
+STATION_FLOW_SLOTS = 24 * 60 // STATION_FLOW_SLOT_MINUTES
+STATION_FLOW_TOP = 20
+# Integer keys that are their own codes over a fixed domain, so counts over
+# them take the same bincount path as categorical keys
+KEY_DOMAINS = {"start_slot": STATION_FLOW_SLOTS, "end_slot": STATION_FLOW_SLOTS}
+# Largest neighborhood to neighborhood flows published per membership
+NEIGHBORHOOD_FLOW_TOP = 20
+# Trip count, duration and revenue are rolled up over every combination of
+# these keys; breakdowns over any subset of them are projections of the cube
+ROLLUP_CUBE_KEYS = ("hour", "weekday", "member_casual", "rideable_type", "start_neighborhood")
+ROLLUP_CUBE_MEASURES = ("ride_duration_ms", "revenue_cents")
+# Cube cells of trips missing a key, which a groupby would have dropped. Integer
+# keys (hour, weekday) keep an integer sentinel, so their labels stay integers.
+MISSING_KEY = ""
+MISSING_INT_KEY = -1
+# Typed arrays the published cube may use, narrowest first
+ROLLUP_CUBE_DTYPES = ("uint8", "uint16", "uint32", "int32", "float64")
+
+# Categories are fixed up front so every chunk shares the same dictionary
+RIDEABLE_TYPES = ["classic_bike", "docked_bike", "electric_bike", "electric_scooter"]
+MEMBERSHIP_TYPES = ["casual", "member"]
+
+# Fixed on-disk schema for the trip store, one Arrow IPC file per month
+TRIP_SCHEMA = pa.schema(
+    [
+        ("ride_id", pa.string()),
+        ("rideable_type", pa.dictionary(pa.int8(), pa.string())),
+        ("started_at", pa.timestamp("ms")),
+        ("ended_at", pa.timestamp("ms")),
+        ("start_station_name", pa.string()),
+        ("start_station_id", pa.string()),
+        ("end_station_name", pa.string()),
+        ("end_station_id", pa.string()),
+        ("start_lat", pa.float32()),
+        ("start_lng", pa.float32()),
+        ("end_lat", pa.float32()),
+        ("end_lng", pa.float32()),
+        ("member_casual", pa.dictionary(pa.int8(), pa.string())),
+    ]
+)
+# dtypes handed to pd.read_csv so nothing is inferred at ingest time
+TRIP_CSV_DTYPES = {
+    "ride_id": "string",
+    "rideable_type": "string",
+    "start_station_name": "string",
+    "start_station_id": "string",
+    "end_station_name": "string",
+    "end_station_id": "string",
+    "start_lat": "float32",
+    "start_lng": "float32",
+    "end_lat": "float32",
+    "end_lng": "float32",
+    "member_casual": "string",
+}
+# Read as strings and then cast, so values outside the fixed categories are
+# counted before they become missing rather than vanishing silently
+TRIP_CSV_CATEGORIES = {
+    "rideable_type": pd.CategoricalDtype(RIDEABLE_TYPES),
+    "member_casual": pd.CategoricalDtype(MEMBERSHIP_TYPES),
+}
+TRIP_DATETIME_COLUMNS = ["started_at", "ended_at"]
+# Read back as categoricals; the start and end columns of each group share one
+# dictionary, so a code means the same station on either end of a trip
+STATION_COLUMN_GROUPS = [
+    ["start_station_name", "end_station_name"],
+    ["start_station_id", "end_station_id"],
+]
+# Columns the enrich stage actually reads back out of the store
+ANALYSIS_COLUMNS = [
+    "rideable_type",
+    "started_at",
+    "ended_at",
+    "start_station_name",
+    "end_station_name",
+    "start_lat",
+    "start_lng",
+    "end_lat",
+    "end_lng",
+    "member_casual",
+]
+
+
+# Stages main() profiles; month stages are recorded once per month processed
+PROFILE_STAGES = [
+    "list",
+    "shapefile",
+    "download",
+    "ingest",
+    "read",
+    "enrich",
+    "aggregate",
+    "stream",
+    "aggregate_sql",
+    "merge",
+    "render",
+    "write",
+]
+
+
+def reset_peak_rss() -> None:
+    """Reset the kernel's RSS high-water mark, so the next reading covers one stage"""
+    with contextlib.suppress(OSError):
+        Path("/proc/self/clear_refs").write_text("5")
+
+
+def get_peak_rss_mb() -> float:
+    with contextlib.suppress(OSError):
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+    # Without procfs only the peak of the whole process is known
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+@dataclass
+class StageRecord:
+    name: str
+    month: Optional[str] = None
+    rows: Optional[int] = None
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+    # Python allocations traced during the stage, when tracemalloc is running
+    traced_delta_mb: Optional[float] = None
+    traced_peak_mb: Optional[float] = None
+
+    @property
+    def rows_per_second(self) -> Optional[float]:
+        if self.rows is None or self.wall_seconds <= 0:
+            return None
+        return self.rows / self.wall_seconds
+
+    def to_json(self) -> dict:
+        return {
+            **{
+                key: round(value, 4) if isinstance(value, float) else value
+                for key, value in asdict(self).items()
+            },
+            "rows_per_second": (
+                round(self.rows_per_second) if self.rows_per_second is not None else None
+            ),
+        }
+
+
+class StageProfiler:
+    """Records the cost of each pipeline stage
+
+    Stages should not nest, since each one resets the peak RSS reading. One stage
+    name can also be run under cProfile, accumulating across every month.
+    """
+
+    def __init__(self, cprofile_stage: Optional[str] = None) -> None:
+        self.records: list[StageRecord] = []
+        self.cprofile_stage = cprofile_stage
+        self.cprofile = cProfile.Profile() if cprofile_stage else None
+
+    @contextlib.contextmanager
+    def stage(self, name: str, month: Optional[str] = None) -> Iterator[StageRecord]:
+        """Measure the block; set rows on the yielded record to get throughput"""
+        record = StageRecord(name, month)
+        reset_peak_rss()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+
+        profiling = self.cprofile is not None and name == self.cprofile_stage
+        if profiling:
+            self.cprofile.enable()
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_seconds = time.perf_counter() - wall_start
+            record.cpu_seconds = time.process_time() - cpu_start
+            if profiling:
+                self.cprofile.disable()
+
+            record.peak_rss_mb = get_peak_rss_mb()
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                record.traced_delta_mb = (current - traced_before) / 2**20
+                record.traced_peak_mb = (peak - traced_before) / 2**20
+
+            self.records.append(record)
+
+    def print_summary(self) -> None:
+        print("Stage profile:")
+        labels = [
+            f"{record.name} {record.month}" if record.month else record.name
+            for record in self.records
+        ]
+        width = max([22, *(len(label) + 2 for label in labels)])
+        for record, label in zip(self.records, labels):
+            throughput = (
+                f"{record.rows_per_second:12,.0f} rows/s"
+                if record.rows_per_second is not None
+                else ""
+            )
+            print(
+                f"  {label:<{width}}{record.wall_seconds:8.2f}s wall{record.cpu_seconds:8.2f}s cpu"
+                f"{record.peak_rss_mb:8.0f} MB{throughput}"
+            )
+
+    def write(self, fp: Path) -> Path:
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_text(
+            json.dumps(
+                {
+                    "stages": [record.to_json() for record in self.records],
+                    "wall_seconds": round(sum(r.wall_seconds for r in self.records), 4),
+                    "cpu_seconds": round(sum(r.cpu_seconds for r in self.records), 4),
+                    "peak_rss_mb": max((r.peak_rss_mb for r in self.records), default=0),
+                },
+                indent=2,
+            )
+        )
+        return fp
+
+    def write_cprofile(self, directory: Path = PROFILE_DIR) -> Optional[Path]:
+        """Dump the cProfile of the chosen stage and print its heaviest calls"""
+        if self.cprofile is None:
+            return
 
+        directory.mkdir(parents=True, exist_ok=True)
+        fp = directory / f"{self.cprofile_stage}.prof"
+        self.cprofile.dump_stats(fp)
+        print(f"cProfile of stage '{self.cprofile_stage}' written to {fp}")
+        pstats.Stats(self.cprofile).sort_stats("cumulative").print_stats(25)
+        return fp
 
-def download_monthly_zipfile(name: str) -> Optional[Path]:
-    resp = requests.get(f"https://{DIVVY_BUCKET_NAME}.s3.amazonaws.com/{name}")
-    with zipfile.ZipFile(io.BytesIO(resp.content)) as zf:
-        for fp in zf.filelist:
-            if not fp.filename.endswith(".csv"):
-                continue
 
-            zf.extract(fp)
-            return Path(fp.filename)
+def profile_stage(
+    profiler: Optional[StageProfiler], name: str
+) -> contextlib.AbstractContextManager:
+    """Measure a part of a stage on its own, when the caller is not measuring the whole"""
+    return profiler.stage(name) if profiler else contextlib.nullcontext()
 
 
-def download_neighborhood_shapefile() -> Optional[Path]:
-    resp = requests.get(NEIGHBORHOOD_SHAPEFILE_LINK)
-    if resp.status_code != 200:
-        raise Exception("Error downloading City of Chicago neighborhood data")
-    with zipfile.ZipFile(io.BytesIO(resp.content)) as zf:
-        shapefile_fp = None
-        for zf_fp in zf.filelist:
-            if zf_fp.filename.endswith(".shp"):
-                shapefile_fp = zf_fp.filename
-                break
+class IncompleteDownload(Exception):
+    """A transfer ended early; the partial file is kept so it can be resumed"""
 
-        if shapefile_fp is None:
-            return
 
-        zf.extractall()
+def get_download_path(url: str) -> Path:
+    digest = hashlib.sha256(url.encode()).hexdigest()[:12]
+    return DOWNLOAD_DIR / f"{digest}-{url.rsplit('/', 1)[-1]}"
+
+
+def get_download_meta_path(fp: Path) -> Path:
+    return fp.with_name(f"{fp.name}.json")
+
+
+def read_download_meta(fp: Path) -> dict:
+    meta_fp = get_download_meta_path(fp)
+    if not meta_fp.is_file():
+        return {}
+    try:
+        return json.loads(meta_fp.read_text())
+    except json.JSONDecodeError:
+        return {}
+
+
+def write_download_meta(fp: Path, meta: dict) -> None:
+    get_download_meta_path(fp).write_text(json.dumps(meta, indent=2))
+
 
-    return Path(shapefile_fp)
+def hash_file(fp: Path, *algorithms: str) -> list[str]:
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(fp, "rb") as fd:
+        while chunk := fd.read(DOWNLOAD_CHUNK_BYTES):
+            for h in hashes:
+                h.update(chunk)
+    return [h.hexdigest() for h in hashes]
+
+
+def is_download_intact(fp: Path, meta: dict) -> bool:
+    """The cached file is exactly what was downloaded, per its recorded size and digest"""
+    if not fp.is_file() or fp.stat().st_size != meta.get("size"):
+        return False
+    [sha256] = hash_file(fp, "sha256")
+    return sha256 == meta.get("sha256")
+
+
+def get_response_meta(url: str, resp: requests.Response) -> dict:
+    return {
+        "url": url,
+        "etag": resp.headers.get("ETag", "").strip('"') or None,
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+
+
+def get_response_size(resp: requests.Response) -> Optional[int]:
+    """Full size of the resource, from Content-Range on a partial response"""
+    if resp.status_code == 206:
+        _, _, total = resp.headers.get("Content-Range", "").rpartition("/")
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def fetch_download(url: str, fp: Path, cached_meta: dict) -> None:
+    """Make one request for url into fp
+
+    The cached copy, if any, is revalidated with its ETag and Last-Modified, and
+    an interrupted transfer left in the .part file is resumed with a Range
+    request, guarded by If-Range so a changed object is fetched from scratch.
+    """
+    part_fp = fp.with_name(f"{fp.name}.part")
+    part_meta = read_download_meta(part_fp)
+
+    headers = {}
+    if cached_meta.get("etag"):
+        headers["If-None-Match"] = f'"{cached_meta["etag"]}"'
+    if cached_meta.get("last_modified"):
+        headers["If-Modified-Since"] = cached_meta["last_modified"]
+
+    offset = part_fp.stat().st_size if part_fp.is_file() else 0
+    validator = (
+        f'"{part_meta["etag"]}"' if part_meta.get("etag") else part_meta.get("last_modified")
+    )
+    if offset and validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+
+    with requests.get(url, headers=headers, stream=True, timeout=60) as resp:
+        if resp.status_code == 304:
+            print(f"'{url}' not modified, using the cached copy")
+            return
+        if resp.status_code == 416:
+            part_fp.unlink()
+            raise IncompleteDownload(f"'{url}' is shorter than its partial download")
+        if resp.status_code not in (200, 206):
+            raise Exception(f"Error downloading '{url}': {resp.status_code}")
+
+        if resp.status_code == 206:
+            print(f"Resuming '{url}' from {offset:,} bytes")
+        else:
+            offset = 0
+            part_meta = get_response_meta(url, resp)
+            write_download_meta(part_fp, part_meta)
+
+        size = get_response_size(resp)
+        with open(part_fp, "ab" if offset else "wb") as fd:
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                fd.write(chunk)
+
+    downloaded = part_fp.stat().st_size
+    if size is not None and downloaded < size:
+        raise IncompleteDownload(f"got {downloaded:,} of {size:,} bytes")
+
+    sha256, md5 = hash_file(part_fp, "sha256", "md5")
+    # Single part S3 uploads have the MD5 of the object as their ETag;
+    # multipart ETags end in -<parts> and can only be checked by size
+    etag = part_meta.get("etag") or ""
+    if (size is not None and downloaded != size) or (
+        re.fullmatch(r"[0-9a-f]{32}", etag) and md5 != etag
+    ):
+        part_fp.unlink()
+        get_download_meta_path(part_fp).unlink(missing_ok=True)
+        raise IncompleteDownload(f"'{url}' failed its integrity check")
+
+    part_fp.replace(fp)
+    write_download_meta(fp, {**part_meta, "size": downloaded, "sha256": sha256})
+    get_download_meta_path(part_fp).unlink(missing_ok=True)
+
+
+def cached_download(url: str, etag: Optional[str] = None) -> Path:
+    """Fetch url through the download cache, transferring nothing if it is unchanged
+
+    When the caller already knows the current ETag, e.g. from the bucket listing,
+    a matching intact cached copy is used without any request at all.
+    """
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    fp = get_download_path(url)
+    meta = read_download_meta(fp)
+    cached = is_download_intact(fp, meta)
+    if cached and etag is not None and meta.get("etag") == etag:
+        print(f"Using the cached download of '{url}'")
+        return fp
+
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            fetch_download(url, fp, meta if cached else {})
+            return fp
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            IncompleteDownload,
+        ) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            print(f"Download of '{url}' interrupted ({e}), retrying...")
+            time.sleep(2**attempt)
+
+    return fp
+
+
+def download_monthly_zipfile(
+    name: str, etag: Optional[str] = None, bucket_url: str = DIVVY_BUCKET_URL
+) -> Optional[Path]:
+    """A monthly trip archive from the download cache, fetched only if it changed"""
+    zip_fp = cached_download(f"{bucket_url}/{name}", etag)
+    if not get_trip_csv_members(zip_fp):
+        return
+
+    return zip_fp
+
+
+def extract_neighborhood_shapefile(zip_fp: Path = NEIGHBORHOOD_SHAPEFILE_ZIP) -> Optional[Path]:
+    """Extract the neighborhood shapefile checked in next to this script
+
+    Each version of the archive is extracted once, into its own directory.
+    """
+    [sha256] = hash_file(zip_fp, "sha256")
+    shapefile_dir = SHAPEFILE_DIR / sha256[:16]
+    if not shapefile_dir.is_dir():
+        tmp_dir = shapefile_dir.with_name(f"{shapefile_dir.name}.part")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        with zipfile.ZipFile(zip_fp) as zf:
+            zf.extractall(tmp_dir)
+        tmp_dir.rename(shapefile_dir)
+
+    return next(shapefile_dir.glob("*.shp"), None)
+
+
+@dataclass
+class BucketObject:
+    key: str
+    etag: str
+    size: int
+    last_modified: str
+
+
+def iter_bucket_objects(
+    bucket_url: str, prefix: str = "", start_after: Optional[str] = None
+) -> Iterator[BucketObject]:
+    """Every object in the bucket under prefix and after start_after, in key order
+
+    Follows ListObjectsV2 continuation tokens past S3's 1000 keys per page, and
+    parses each page as it streams in rather than loading the whole document.
+    """
+    params = {"list-type": "2", "prefix": prefix}
+    if start_after:
+        params["start-after"] = start_after
+
+    while True:
+        token = None
+        with requests.get(bucket_url, params=params, stream=True, timeout=60) as resp:
+            if resp.status_code != 200:
+                raise Exception(f"Failed getting bucket objects: {resp.status_code}")
+
+            resp.raw.decode_content = True
+            for _, elem in ET.iterparse(resp.raw):
+                if elem.tag == f"{S3_NAMESPACE}Contents":
+                    yield BucketObject(
+                        key=elem.findtext(f"{S3_NAMESPACE}Key", default=""),
+                        etag=elem.findtext(f"{S3_NAMESPACE}ETag", default="").strip('"'),
+                        size=int(elem.findtext(f"{S3_NAMESPACE}Size", default="0")),
+                        last_modified=elem.findtext(f"{S3_NAMESPACE}LastModified", default=""),
+                    )
+                    elem.clear()
+                elif elem.tag == f"{S3_NAMESPACE}NextContinuationToken":
+                    token = elem.text
+
+        if not token:
+            return
+        params["continuation-token"] = token
+
+
+def load_bucket_manifest(
+    bucket_url: str, fp: Path = BUCKET_MANIFEST_FP
+) -> dict[str, BucketObject]:
+    if not fp.is_file():
+        return {}
+
+    manifest = json.loads(fp.read_text())
+    if manifest.get("bucket_url") != bucket_url:
+        return {}
+    return {obj["key"]: BucketObject(**obj) for obj in manifest["objects"]}
+
+
+def save_bucket_manifest(
+    bucket_url: str, objects: dict[str, BucketObject], fp: Path = BUCKET_MANIFEST_FP
+) -> None:
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    manifest = {
+        "bucket_url": bucket_url,
+        "objects": [asdict(objects[key]) for key in sorted(objects)],
+    }
+    tmp_fp = fp.with_suffix(".part")
+    tmp_fp.write_text(json.dumps(manifest, indent=2))
+    tmp_fp.replace(fp)
+
+
+def update_bucket_manifest(
+    bucket_url: str = DIVVY_BUCKET_URL,
+    refresh: bool = False,
+    first_month: Optional[str] = None,
+) -> dict[str, BucketObject]:
+    """Bring the local manifest of monthly archives up to date
+
+    Listing starts just before the earliest key of first_month or later, so
+    the ETags of the months about to be published are revalidated and an
+    archive republished under the same key is seen. Without first_month only
+    keys after the newest one in the manifest are listed. Either way it is a
+    single request; a refresh relists everything.
+    """
+    objects = {} if refresh else load_bucket_manifest(bucket_url)
+    earlier = [
+        key
+        for key in sorted(objects)
+        if first_month is None or get_month_from_key(key) < first_month
+    ]
+    start_after = earlier[-1] if earlier else None
+
+    # Keys past start_after are relisted, so drop any the bucket no longer has
+    known = {key: objects.pop(key) for key in list(objects) if key not in earlier}
+    new_keys, changed_keys = [], []
+    for obj in iter_bucket_objects(bucket_url, MONTHLY_KEY_PREFIX, start_after):
+        if FILENAME_PATTERN.fullmatch(obj.key):
+            objects[obj.key] = obj
+            if obj.key not in known:
+                new_keys.append(obj.key)
+            elif known[obj.key].etag != obj.etag:
+                changed_keys.append(obj.key)
+
+    print(
+        f"Found {len(new_keys)} new and {len(changed_keys)} republished monthly "
+        "archives in the bucket"
+    )
+    save_bucket_manifest(bucket_url, objects)
+    return objects
+
+
+def list_bucket_objects(
+    bucket_url: str = DIVVY_BUCKET_URL,
+    refresh: bool = False,
+    first_month: Optional[str] = None,
+) -> dict[str, str]:
+    """Map every monthly trip archive key in the bucket to its ETag"""
+    objects = update_bucket_manifest(bucket_url, refresh, first_month)
+    return {key: obj.etag for key, obj in objects.items()}
+
+
+def get_month_from_key(key: str) -> str:
+    month, *_ = key.split("-", maxsplit=1)
+    return month
+
+
+def get_month_store_path(month: str) -> Path:
+    return TRIP_STORE_DIR / f"month={month}" / "trips.arrow"
+
+
+def get_stored_month_etag(month: str) -> Optional[str]:
+    """ETag of the archive a stored month was ingested from, if it is stored"""
+    store_fp = get_month_store_path(month)
+    if not store_fp.is_file():
+        return
+
+    with pa.memory_map(str(store_fp)) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+
+    return metadata.get(b"etag", b"").decode()
+
+
+def get_stored_month_rows(month: str) -> int:
+    return feather.read_table(get_month_store_path(month), columns=[], memory_map=True).num_rows
+
+
+def get_trip_csv_members(zip_fp: Path) -> list[str]:
+    with zipfile.ZipFile(zip_fp) as zf:
+        return [
+            name
+            for name in zf.namelist()
+            if name.endswith(".csv") and not name.startswith("__MACOSX/")
+        ]
+
+
+def iter_trip_csv_chunks(
+    zip_fp: Path, chunksize: int = INGEST_CHUNK_ROWS
+) -> Iterator[pa.RecordBatch]:
+    """Yield typed record batches straight out of the CSV members of a trip archive"""
+    with zipfile.ZipFile(zip_fp) as zf:
+        for member in get_trip_csv_members(zip_fp):
+            unknown = {column: Counter() for column in TRIP_CSV_CATEGORIES}
+            with zf.open(member) as fd:
+                reader = pd.read_csv(
+                    fd,
+                    usecols=TRIP_SCHEMA.names,
+                    dtype=TRIP_CSV_DTYPES,
+                    chunksize=chunksize,
+                )
+                for chunk in reader:
+                    for column, dtype in TRIP_CSV_CATEGORIES.items():
+                        values = chunk[column].astype(dtype)
+                        dropped = chunk[column][values.isna() & chunk[column].notna()]
+                        unknown[column].update(dropped.value_counts().to_dict())
+                        chunk[column] = values
+
+                    for column in TRIP_DATETIME_COLUMNS:
+                        chunk[column] = pd.to_datetime(
+                            chunk[column], format="ISO8601", errors="coerce"
+                        )
+
+                    yield pa.RecordBatch.from_pandas(
+                        chunk[TRIP_SCHEMA.names],
+                        schema=TRIP_SCHEMA,
+                        preserve_index=False,
+                    )
+
+            print(f"Read '{member}'")
+            for column, counts in unknown.items():
+                if counts:
+                    values = ", ".join(f"'{k}' ({v:,})" for k, v in counts.most_common())
+                    print(
+                        f"Warning: {counts.total():,} trips in '{member}' have an "
+                        f"unknown {column}, ingested as missing: {values}"
+                    )
+
+
+def ingest_zipfile_to_trip_store(
+    zip_fp: Path, month: str, etag: str = "", chunksize: int = INGEST_CHUNK_ROWS
+) -> Path:
+    """Write a month of trips to the columnar trip store one chunk at a time"""
+    store_fp = get_month_store_path(month)
+    store_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = store_fp.with_suffix(".tmp")
+
+    # Uncompressed so that reads can memory-map the file without copying
+    num_rows = 0
+    with pa.OSFile(str(tmp_fp), "wb") as sink:
+        schema = TRIP_SCHEMA.with_metadata({"etag": etag})
+        with pa.ipc.new_file(sink, schema) as writer:
+            for batch in iter_trip_csv_chunks(zip_fp, chunksize):
+                writer.write_batch(batch)
+                num_rows += batch.num_rows
+
+    tmp_fp.replace(store_fp)
+
+    print(f"Wrote {num_rows} trips to '{store_fp}'")
+    return store_fp
+
+
+def read_trips_from_store(
+    months: list[str], columns: Optional[list[str]] = None
+) -> pd.DataFrame:
+    tables = [
+        feather.read_table(
+            get_month_store_path(month), columns=columns, memory_map=True
+        )
+        for month in months
+    ]
+    return trips_to_frame(pa.concat_tables(tables))
 
 
-def list_all_bucket_keys() -> list[str]:
-    resp = requests.get(f"https://{DIVVY_BUCKET_NAME}.s3.amazonaws.com")
-    if resp.status_code != 200:
-        raise Exception("Failed getting bucket objects")
+def iter_trips_from_store(
+    month: str, columns: Optional[list[str]] = None
+) -> Iterator[pd.DataFrame]:
+    """Read a month back one record batch (one ingest chunk) at a time"""
+    with pa.memory_map(str(get_month_store_path(month))) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            table = pa.Table.from_batches([reader.get_batch(i)])
+            yield trips_to_frame(table.select(columns) if columns else table)
 
-    root = ET.fromstring(resp.content)
 
-    keys = [
-        elem.text
-        for elem in root.iter("{http://s3.amazonaws.com/doc/2006-03-01/}Key")
-        if elem.text
+def trips_to_frame(table: pa.Table) -> pd.DataFrame:
+    groups = [
+        [name for name in group if name in table.column_names]
+        for group in STATION_COLUMN_GROUPS
     ]
-    return [key for key in keys if FILENAME_PATTERN.match(key)]
+    df = table.drop_columns([name for group in groups for name in group]).to_pandas()
+    for station_columns in groups:
+        if not station_columns:
+            continue
 
+        stations = build_station_dictionary(
+            [table.column(name) for name in station_columns]
+        )
+        for name in station_columns:
+            df[name] = encode_stations(table.column(name), stations)
 
-def get_most_recent_filename() -> Optional[str]:
-    return sorted(list_all_bucket_keys())[-1]
+    return df[table.column_names]
 
 
-def load_csv_files_to_sqlite(conn: sqlite3.Connection, raw_data_fp: Path) -> None:
-    if raw_data_fp.is_file():
-        to_load = [raw_data_fp]
-    else:
-        to_load = [fp for fp in raw_data_fp.glob("*.csv") if fp.is_file()]
+def build_station_dictionary(columns: list[pa.ChunkedArray]) -> pa.Array:
+    """Every station name (or id) in the columns, sorted so codes order like them"""
+    chunks = [chunk for column in columns for chunk in column.chunks]
+    names = pc.unique(pa.chunked_array(chunks, type=pa.string())).drop_null()
+    return names.take(pc.sort_indices(names))
+
+
+def encode_stations(column: pa.ChunkedArray, stations: pa.Array) -> pd.Categorical:
+    """Dictionary encode stations without materializing a string per trip"""
+    codes = pc.index_in(column, value_set=stations).fill_null(-1)
+    return pd.Categorical.from_codes(
+        codes.to_numpy().astype(np.int32),
+        categories=pd.Index(stations.to_pylist(), dtype=object),
+    )
+
+
+def get_shapefile_hash(shapefile_fp: Path) -> str:
+    """Content hash of a shapefile and its sidecar files"""
+    digest = hashlib.sha256()
+    for fp in sorted(shapefile_fp.parent.glob(f"{shapefile_fp.stem}.*")):
+        digest.update(fp.suffix.encode())
+        digest.update(fp.read_bytes())
+
+    return digest.hexdigest()[:16]
+
+
+def quantize_coordinates(lat: pd.Series, lng: pd.Series, precision: int) -> np.ndarray:
+    """Pack coordinates into int64 ids of the grid cell (of 10**-precision degrees) they fall in"""
+    scale = 10**precision
+    lat_q = np.floor(lat.to_numpy(dtype=np.float64) * scale)
+    lng_q = np.floor(lng.to_numpy(dtype=np.float64) * scale)
+    missing = np.isnan(lat_q) | np.isnan(lng_q)
+
+    keys = (np.nan_to_num(lat_q) + 90 * scale) * (360 * scale + 1) + (
+        np.nan_to_num(lng_q) + 180 * scale
+    )
+    keys = keys.astype(np.int64)
+    keys[missing] = -1
+    return keys
+
+
+def dequantize_coordinates(
+    keys: np.ndarray, precision: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """South-west corner of each grid cell"""
+    scale = 10**precision
+    lat_q, lng_q = np.divmod(keys, 360 * scale + 1)
+    return (lat_q - 90 * scale) / scale, (lng_q - 180 * scale) / scale
+
+
+@dataclass
+class CoordinateIndex:
+    """Sorted grid cell ids and the neighborhood code resolved for each"""
+
+    keys: np.ndarray
+    codes: np.ndarray
+
+    @classmethod
+    def empty(cls) -> "CoordinateIndex":
+        return cls(np.empty(0, np.int64), np.empty(0, np.int16))
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        if len(self.keys) == 0:
+            return np.full(len(keys), NO_NEIGHBORHOOD, dtype=np.int16)
+
+        positions = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        return np.where(found, self.codes[positions], NO_NEIGHBORHOOD).astype(np.int16)
+
+    def unseen(self, keys: np.ndarray) -> np.ndarray:
+        unseen = np.setdiff1d(keys, self.keys)
+        return unseen[unseen >= 0]
+
+    def extend(self, keys: np.ndarray, codes: np.ndarray) -> "CoordinateIndex":
+        keys = np.concatenate([self.keys, keys])
+        codes = np.concatenate([self.codes, codes])
+        order = np.argsort(keys, kind="stable")
+        return CoordinateIndex(keys[order], codes[order])
+
 
-    for fp in to_load:
-        df = pd.read_csv(fp)
-        df.to_sql(DIVVY_TABLE_NAME, conn, if_exists="append", index=False)
+@dataclass
+class NeighborhoodIndex:
+    """Neighborhoods of coarse grid cells, plus exact points for boundary cells"""
 
-        print(f"Loaded '{fp}'")
+    names: list[str]
+    cells: CoordinateIndex
+    points: CoordinateIndex
 
 
-def get_neighborhoods(df: pd.DataFrame, shapefile_fp: Path) -> pd.DataFrame:
+def get_neighborhood_index_path(shapefile_hash: str, grid_precision: int) -> Path:
+    return NEIGHBORHOOD_INDEX_DIR / f"{shapefile_hash}.grid{grid_precision}.npz"
+
+
+def load_neighborhood_index(
+    shapefile_hash: str, grid_precision: int
+) -> NeighborhoodIndex:
+    index_fp = get_neighborhood_index_path(shapefile_hash, grid_precision)
+    if not index_fp.is_file():
+        return NeighborhoodIndex([], CoordinateIndex.empty(), CoordinateIndex.empty())
+
+    with np.load(index_fp) as data:
+        return NeighborhoodIndex(
+            data["names"].tolist(),
+            CoordinateIndex(data["cell_keys"], data["cell_codes"]),
+            CoordinateIndex(data["point_keys"], data["point_codes"]),
+        )
+
+
+def save_neighborhood_index(
+    shapefile_hash: str, grid_precision: int, index: NeighborhoodIndex
+) -> Path:
+    index_fp = get_neighborhood_index_path(shapefile_hash, grid_precision)
+    index_fp.parent.mkdir(parents=True, exist_ok=True)
+    # Backfill workers may save at once; the last one wins, and cells only it
+    # lacks are resolved again the next time they are seen
+    tmp_fp = index_fp.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_fp, "wb") as fd:
+        np.savez(
+            fd,
+            names=np.array(index.names),
+            cell_keys=index.cells.keys,
+            cell_codes=index.cells.codes,
+            point_keys=index.points.keys,
+            point_codes=index.points.codes,
+        )
+
+    tmp_fp.replace(index_fp)
+    return index_fp
+
+
+@functools.lru_cache(maxsize=None)
+def load_neighborhood_polygons(shapefile_fp: Path) -> tuple[list[str], np.ndarray, Any]:
+    """Neighborhood names, the name code of each polygon and an STRtree over them"""
+    import geopandas as gpd
+
     neighborhoods = gpd.read_file(shapefile_fp)
+    names = sorted(neighborhoods["pri_neigh"].unique())
+    polygon_codes = (
+        neighborhoods["pri_neigh"]
+        .map({name: code for code, name in enumerate(names)})
+        .to_numpy(dtype=np.int16)
+    )
+    return names, polygon_codes, shapely.STRtree(neighborhoods.geometry.values)
+
+
+def first_matches(
+    num_inputs: int, input_idx: np.ndarray, match_codes: np.ndarray
+) -> np.ndarray:
+    # Overlapping polygons resolve to the first match, so no trip is duplicated
+    codes = np.full(num_inputs, NO_NEIGHBORHOOD, dtype=np.int16)
+    input_idx, first = np.unique(input_idx, return_index=True)
+    codes[input_idx] = match_codes[first]
+    return codes
+
+
+def resolve_neighborhood_cells(
+    keys: np.ndarray, grid_precision: int, shapefile_fp: Path
+) -> np.ndarray:
+    """Neighborhood of every grid cell lying entirely inside one, BOUNDARY_CELL otherwise"""
+
+    _, polygon_codes, tree = load_neighborhood_polygons(shapefile_fp)
+    lat, lng = dequantize_coordinates(keys, grid_precision)
+    size = 10.0**-grid_precision
+    cells = shapely.box(lng, lat, lng + size, lat + size)
+
+    cell_idx, polygon_idx = tree.query(cells, predicate="within")
+    codes = first_matches(len(keys), cell_idx, polygon_codes[polygon_idx])
+
+    # Cells that touch a polygon without lying inside one straddle a boundary
+    touching_idx, _ = tree.query(cells, predicate="intersects")
+    straddling = np.zeros(len(keys), dtype=bool)
+    straddling[touching_idx] = True
+    codes[straddling & (codes == NO_NEIGHBORHOOD)] = BOUNDARY_CELL
+    return codes
+
+
+def resolve_neighborhood_points(keys: np.ndarray, shapefile_fp: Path) -> np.ndarray:
+    """Exact point-in-polygon test at COORDINATE_PRECISION"""
+
+    _, polygon_codes, tree = load_neighborhood_polygons(shapefile_fp)
+    lat, lng = dequantize_coordinates(keys, COORDINATE_PRECISION)
+    point_idx, polygon_idx = tree.query(shapely.points(lng, lat), predicate="within")
+    return first_matches(len(keys), point_idx, polygon_codes[polygon_idx])
+
+
+def get_neighborhoods(
+    df: pd.DataFrame,
+    shapefile_fp: Path,
+    grid_precision: int = NEIGHBORHOOD_GRID_PRECISION,
+) -> pd.DataFrame:
+    """Attach start and end neighborhoods from the persistent grid cell index
+
+    The density grid cells of both ends are binned in the same pass over the
+    coordinates.
+    """
+    shapefile_hash = get_shapefile_hash(shapefile_fp)
+    index = load_neighborhood_index(shapefile_hash, grid_precision)
+    updated = False
+
+    ends = {}
+    for end in ("start", "end"):
+        ends[end] = quantize_coordinates(
+            df[f"{end}_lat"], df[f"{end}_lng"], grid_precision
+        )
+        df[f"{end}_cell"] = density_cells(df[f"{end}_lat"], df[f"{end}_lng"])
+
+    unseen = index.cells.unseen(np.concatenate(list(ends.values())))
+    if len(unseen) > 0:
+        print(f"Resolving {len(unseen)} new grid cells...")
+        index.names = load_neighborhood_polygons(shapefile_fp)[0]
+        index.cells = index.cells.extend(
+            unseen, resolve_neighborhood_cells(unseen, grid_precision, shapefile_fp)
+        )
+        updated = True
+
+    codes = {end: index.cells.lookup(cell_keys) for end, cell_keys in ends.items()}
+
+    # Points in cells that straddle a boundary fall back to the exact point test
+    point_keys = {}
+    for end, end_codes in codes.items():
+        boundary = np.flatnonzero(end_codes == BOUNDARY_CELL)
+        point_keys[end] = (
+            boundary,
+            quantize_coordinates(
+                df[f"{end}_lat"].iloc[boundary],
+                df[f"{end}_lng"].iloc[boundary],
+                COORDINATE_PRECISION,
+            ),
+        )
+
+    unseen = index.points.unseen(
+        np.concatenate([keys for _, keys in point_keys.values()])
+    )
+    if len(unseen) > 0:
+        print(f"Resolving {len(unseen)} new boundary points...")
+        index.points = index.points.extend(
+            unseen, resolve_neighborhood_points(unseen, shapefile_fp)
+        )
+        updated = True
+
+    if updated:
+        save_neighborhood_index(shapefile_hash, grid_precision, index)
+
+    for end, (boundary, keys) in point_keys.items():
+        codes[end][boundary] = index.points.lookup(keys)
+        df[f"{end}_neighborhood"] = pd.Categorical.from_codes(
+            codes[end], categories=index.names
+        )
 
-    # Prepare unique start points
-    start_points = df[["start_lat", "start_lng"]].drop_duplicates().copy()
-    start_gdf = gpd.GeoDataFrame(
-        start_points,
-        geometry=gpd.points_from_xy(start_points.start_lng, start_points.start_lat),
-        crs=neighborhoods.crs,
-    )
-    start_neigh = gpd.sjoin(
-        start_gdf,
-        neighborhoods[["pri_neigh", "geometry"]],
-        how="left",
-        predicate="within",
-    )[["start_lat", "start_lng", "pri_neigh"]]
-    start_neigh = start_neigh.rename(columns={"pri_neigh": "start_neighborhood"})
-
-    # Prepare unique end points
-    end_points = df[["end_lat", "end_lng"]].drop_duplicates().copy()
-    end_gdf = gpd.GeoDataFrame(
-        end_points,
-        geometry=gpd.points_from_xy(end_points.end_lng, end_points.end_lat),
-        crs=neighborhoods.crs,
-    )
-    end_neigh = gpd.sjoin(
-        end_gdf,
-        neighborhoods[["pri_neigh", "geometry"]],
-        how="left",
-        predicate="within",
-    )[["end_lat", "end_lng", "pri_neigh"]]
-    end_neigh = end_neigh.rename(columns={"pri_neigh": "end_neighborhood"})
-
-    # Merge back to main DataFrame
-    df = df.merge(start_neigh, on=["start_lat", "start_lng"], how="left")
-    df = df.merge(end_neigh, on=["end_lat", "end_lng"], how="left")
     return df
 
 
-def calculate_revenue_vectorized(df: pd.DataFrame) -> pd.Series:
-    # Base rates and minute rates
-    base_rate = pd.Series(0, index=df.index, dtype=float)
-    minute_rate = pd.Series(0, index=df.index, dtype=float)
-    ride_duration = df["ride_duration"].copy()
-
-    # Member logic
-    is_member = df["member_casual"] == "member"
-    is_electric = df["rideable_type"] == "electric_bike"
-    is_classic = df["rideable_type"] == "classic_bike"
-
-    # Member, electric
-    minute_rate.loc[is_member & is_electric] = 0.18
-    # Member, classic, over 45 min
-    classic_long = is_member & is_classic & (ride_duration > 45)
-    minute_rate.loc[classic_long] = 0.18
-    ride_duration.loc[classic_long] = ride_duration.loc[classic_long] - 45
-
-    # Casual logic
-    is_casual = df["member_casual"] == "casual"
-    base_rate.loc[is_casual] = 1
-    minute_rate.loc[is_casual & is_electric] = 0.44
-    minute_rate.loc[is_casual & is_classic] = 0.18
-
-    revenue = base_rate + (minute_rate * ride_duration)
-    # Add $1.20 if end_station_name is NA
-    revenue = revenue + df["end_station_name"].isna() * 1.20
-    return revenue
-
-
-def categorize_time_of_day(hour):
-    if 5 <= hour < 12:
-        return "Morning"
-    elif 12 <= hour < 17:
-        return "Afternoon"
-    elif 17 <= hour < 21:
-        return "Evening"
-    else:
-        return "Night"
+@dataclass(frozen=True)
+class FeeSchedule:
+    """Divvy's fees, in cents, from the month they took effect"""
+
+    effective_from: int  # YYYYMM
+    # (member_casual, rideable_type) -> (unlock fee, included minutes, per minute)
+    rates: dict[tuple[str, str], tuple[int, int, int]]
+    # Charged when a trip ends away from a station
+    undocked_fee: int
+
+
+# Every fee schedule, oldest first. Trips are priced with the schedule in effect
+# when they started, so add an entry here when prices change rather than editing
+# one, and cached months keep the prices they were ridden at.
+FEE_SCHEDULES = [
+    FeeSchedule(
+        effective_from=202004,
+        rates={
+            ("casual", "classic_bike"): (100, 0, 18),
+            ("casual", "docked_bike"): (100, 0, 0),
+            ("casual", "electric_bike"): (100, 0, 44),
+            ("casual", "electric_scooter"): (100, 0, 0),
+            ("member", "classic_bike"): (0, 45, 18),
+            ("member", "docked_bike"): (0, 0, 0),
+            ("member", "electric_bike"): (0, 0, 18),
+            ("member", "electric_scooter"): (0, 0, 0),
+        },
+        undocked_fee=120,
+    ),
+]
+
+TIME_OF_DAYS = ["Night", "Morning", "Afternoon", "Evening"]
+# Hours each bucket starts at, and the time of day of each bucket. Hours before
+# the first edge (and unknown hours) fall into the last bucket, so Night wraps.
+TIME_OF_DAY_EDGES = [5, 12, 17, 21]
+TIME_OF_DAY_BUCKETS = np.array([0, 1, 2, 3, 0], dtype=np.int8)
+
+
+def build_fee_table(
+    schedules: list[FeeSchedule],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Lay the fee schedules out as arrays indexed by schedule and category codes
+
+    Returns the effective months and a (schedule, membership, rideable type, fee)
+    array of unlock fee, included minutes and per minute rate, with one extra
+    trailing membership and rideable slot of zeros for missing categories, and
+    the undocked fee per schedule.
+    """
+    effective = np.array([schedule.effective_from for schedule in schedules])
+    rates = np.zeros(
+        (len(schedules), len(MEMBERSHIP_TYPES) + 1, len(RIDEABLE_TYPES) + 1, 3),
+        dtype=np.int64,
+    )
+    for i, schedule in enumerate(schedules):
+        for (membership, rideable_type), fees in schedule.rates.items():
+            rates[
+                i,
+                MEMBERSHIP_TYPES.index(membership),
+                RIDEABLE_TYPES.index(rideable_type),
+            ] = fees
+
+    undocked = np.array([schedule.undocked_fee for schedule in schedules])
+    return effective, rates, undocked
+
+
+def category_codes(values: pd.Series, categories: list[str]) -> np.ndarray:
+    """Codes of values in a fixed category list, with missing values last"""
+    codes = pd.Categorical(values, categories=categories).codes.astype(np.intp)
+    codes[codes < 0] = len(categories)
+    return codes
+
+
+def calculate_revenue_cents(
+    df: pd.DataFrame, schedules: list[FeeSchedule] = FEE_SCHEDULES
+) -> np.ndarray:
+    """Price every trip in whole cents with the fees in effect when it started
+
+    Trips without a duration are left unpriced (NaN). Cents are kept in a float
+    array so they can carry NaN, but every value is integral, so sums are exact
+    and independent of the order trips are added in.
+    """
+    effective, rates, undocked = build_fee_table(schedules)
+    started_at = df["started_at"]
+    trip_month = (started_at.dt.year * 100 + started_at.dt.month).to_numpy(
+        dtype=np.float64, na_value=np.nan
+    )
+    schedule = np.searchsorted(effective, trip_month, side="right") - 1
+    # Trips from before the first schedule are priced with the oldest fees
+    schedule = np.clip(schedule, 0, len(schedules) - 1)
+
+    fees = rates[
+        schedule,
+        category_codes(df["member_casual"], MEMBERSHIP_TYPES),
+        category_codes(df["rideable_type"], RIDEABLE_TYPES),
+    ]
+    unlock, included, per_minute = fees[:, 0], fees[:, 1], fees[:, 2]
+
+    ride_duration = df["ride_duration"].to_numpy(dtype=np.float64, na_value=np.nan)
+    billable_minutes = np.maximum(ride_duration - included, 0)
+    revenue = unlock + per_minute * billable_minutes
+    revenue += undocked[schedule] * df["end_station_name"].isna().to_numpy()
+    return np.rint(revenue)
+
+
+def cents_to_dollars(cents: Any) -> Any:
+    return cents / 100
 
 
-def calculate_station_activity(df: pd.DataFrame) -> pd.DataFrame:
-    total_rides = len(df)
+def quantile_buckets(values: pd.Series) -> pd.Series:
+    """Index of the log bucket each value falls in, so quantiles can be read off counts"""
+    x = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        buckets = np.ceil(np.log(x) / np.log(QUANTILE_GAMMA))
 
-    start_station_counts = df["start_station_name"].value_counts().head(10)
+    buckets[x <= 0] = ZERO_BUCKET
+    return pd.Series(
+        pd.array(buckets, dtype="Int16"), index=values.index
+    ).where(~np.isnan(x))
+
+
+def quantile_bucket_values(buckets: np.ndarray) -> np.ndarray:
+    """Value each bucket stands for, within the relative accuracy of all its members"""
+    values = 2 * QUANTILE_GAMMA ** buckets.astype(np.float64) / (QUANTILE_GAMMA + 1)
+    return np.where(buckets == ZERO_BUCKET, 0, values)
+
+
+def histogram_bins(values: pd.Series, edges: list[int]) -> pd.Series:
+    """Histogram bin of each value, anything below the first edge joining the first bin"""
+    x = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    bins = np.maximum(np.searchsorted(edges, x, side="right") - 1, 0)
+    return pd.Series(pd.array(bins, dtype="Int16"), index=values.index).where(~np.isnan(x))
+
+
+def haversine_meters(df: pd.DataFrame) -> np.ndarray:
+    """Great-circle distance between each trip's ends, in one float32 pass"""
+    lat1, lng1, lat2, lng2 = (
+        np.radians(df[column].to_numpy(dtype=np.float32, na_value=np.nan))
+        for column in ("start_lat", "start_lng", "end_lat", "end_lng")
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    # Rounding can push a just past 1 for nearly antipodal points
+    return np.float32(2 * EARTH_RADIUS_METERS) * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def trip_speeds_kmh(distance_m: pd.Series, ride_duration_ms: pd.Series) -> np.ndarray:
+    """Average straight-line speed of each trip, missing for trips without a duration"""
+    distance = distance_m.to_numpy(dtype=np.float64, na_value=np.nan)
+    duration = ride_duration_ms.to_numpy(dtype=np.float64, na_value=np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speed = np.where(duration > 0, distance * 3600 / duration, np.nan)
+    return speed.astype(np.float32)
+
+
+def flag_implausible_trips(df: pd.DataFrame) -> np.ndarray:
+    stationary = (df["distance_m"] == 0) & (
+        df["ride_duration_ms"] > IMPLAUSIBLE_STATIONARY_MINUTES * 60_000
+    )
+    return (stationary | (df["speed_kmh"] > IMPLAUSIBLE_SPEED_KMH)).to_numpy()
+
+
+def meters_to_kilometers(meters: Any) -> Any:
+    return meters / 1000
+
+
+def day_slots(timestamps: pd.Series) -> pd.Series:
+    """Slot of the day each timestamp falls in"""
+    minutes = timestamps.dt.hour * 60 + timestamps.dt.minute
+    return (minutes // STATION_FLOW_SLOT_MINUTES).astype("Int16")
+
+
+def categorize_time_of_day(hours: pd.Series) -> pd.Categorical:
+    """Bucket start hours into times of day, missing for trips without a start"""
+    hours = hours.to_numpy(dtype=np.float64, na_value=np.nan)
+    buckets = np.searchsorted(TIME_OF_DAY_EDGES, hours, side="right")
+    codes = np.where(np.isnan(hours), -1, TIME_OF_DAY_BUCKETS[buckets])
+    return pd.Categorical.from_codes(codes, TIME_OF_DAYS)
+
+
+def sort_counts(counts: pd.Series) -> pd.Series:
+    """Order counts like value_counts, breaking ties on the key so output is stable"""
+    return counts.sort_index(kind="stable").sort_values(ascending=False, kind="stable")
+
+
+def calculate_station_activity(
+    start_counts: pd.Series, end_counts: pd.Series, total_rides: int
+) -> pd.DataFrame:
+    start_station_counts = sort_counts(start_counts).head(10)
     start_station_percentages = (start_station_counts / total_rides) * 100
 
     start_station_stats = pd.DataFrame(
@@ -186,7 +1276,7 @@ def calculate_station_activity(df: pd.DataFrame) -> pd.DataFrame:
         }
     )
 
-    end_station_counts = df["end_station_name"].value_counts().head(10)
+    end_station_counts = sort_counts(end_counts).head(10)
     end_station_percentages = (end_station_counts / total_rides) * 100
 
     end_station_stats = pd.DataFrame(
@@ -215,59 +1305,78 @@ def calculate_station_activity(df: pd.DataFrame) -> pd.DataFrame:
     combined_stats = combined_stats[
         ["station_name", "total_ride_count", "total_ride_percent"]
     ]
-    combined_stats = combined_stats.sort_values(by="total_ride_count", ascending=False)
+    combined_stats = combined_stats.sort_values(
+        by="total_ride_count", ascending=False, kind="stable"
+    )
     return combined_stats
 
 
-def calculate_popular_routes(df: pd.DataFrame) -> pd.DataFrame:
+def calculate_popular_routes(
+    route_counts: pd.Series, non_round_trip_count: int
+) -> pd.DataFrame:
     """Calculate the most popular routes (start station -> end station pairs)"""
-    # Filter out round trips (start station == end station)
-    df_filtered = df[df["start_station_name"] != df["end_station_name"]].copy()
-    
-    # Create route column
-    df_filtered["route"] = df_filtered["start_station_name"] + " → " + df_filtered["end_station_name"]
-    
-    # Count routes and calculate percentages
-    route_counts = df_filtered["route"].value_counts().head(10)
-    total_rides = len(df_filtered)
-    route_percentages = (route_counts / total_rides) * 100
-    
+    top_routes = sort_counts(route_counts).head(10)
+    route_percentages = (top_routes / non_round_trip_count) * 100
+
     return pd.DataFrame({
-        "route": route_counts.index,
-        "ride_count": route_counts.values,
+        "route": [f"{start} → {end}" for start, end in top_routes.index],
+        "ride_count": top_routes.values,
         "ride_percent": route_percentages.values
     })
 
 
-def calculate_peak_hours(df: pd.DataFrame) -> pd.DataFrame:
+def calculate_popular_routes_from_sketches(
+    heavy_hitters: pd.DataFrame, count_min: pd.DataFrame, non_round_trip_count: int
+) -> pd.DataFrame:
+    """Most popular routes from the streaming sketches, with the error of each count
+
+    A route's count is the tighter of its Space-Saving and Count-Min upper bounds;
+    the true count is at most ride_count_error below it.
+    """
+    upper = np.minimum(
+        heavy_hitters["ride_count"].to_numpy(),
+        estimate_count_min(count_min, heavy_hitters.index),
+    )
+    lower = heavy_hitters["ride_count"] - heavy_hitters["ride_count_error"]
+    routes = pd.DataFrame(
+        {"ride_count": upper, "ride_count_error": upper - lower.clip(lower=0)},
+        index=heavy_hitters.index,
+    )
+    top_routes = routes.loc[sort_counts(routes["ride_count"]).head(10).index]
+
+    return pd.DataFrame({
+        "route": [f"{start} → {end}" for start, end in top_routes.index],
+        "ride_count": top_routes["ride_count"].values,
+        "ride_count_error": top_routes["ride_count_error"].values,
+        "ride_percent": (top_routes["ride_count"] / non_round_trip_count * 100).values,
+    })
+
+
+def calculate_peak_hours(hourly: pd.DataFrame, total_rides: int) -> pd.DataFrame:
     """Calculate hourly usage patterns"""
-    # Extract hour from started_at
-    df["hour"] = df["started_at"].dt.hour
-    
-    # Count rides by hour
-    hourly_counts = df["hour"].value_counts().sort_index()
-    total_rides = len(df)
+    hourly = hourly.sort_index()
+    hourly_counts = hourly["ride_count"]
     hourly_percentages = (hourly_counts / total_rides) * 100
-    
+
     # Calculate average revenue by hour
-    hourly_revenue = df.groupby("hour")["estimated_revenue"].mean()
-    
+    hourly_revenue = cents_to_dollars(
+        hourly["revenue_cents_sum"] / hourly["revenue_cents_count"]
+    )
+
     return pd.DataFrame({
-        "hour": hourly_counts.index,
+        "hour": hourly.index.astype(int),
         "ride_count": hourly_counts.values,
         "ride_percent": hourly_percentages.values,
         "avg_revenue": hourly_revenue.values
     })
 
 
-def calculate_station_efficiency(df: pd.DataFrame) -> pd.DataFrame:
+def calculate_station_efficiency(
+    start_counts: pd.Series, end_counts: pd.Series, total_rides: int
+) -> pd.DataFrame:
     """Calculate station efficiency metrics including turnover rates"""
-    total_rides = len(df)
-    
-    # Calculate start and end counts for each station
-    start_counts = df["start_station_name"].value_counts()
-    end_counts = df["end_station_name"].value_counts()
-    
+    start_counts = start_counts.sort_index()
+
     # Combine into efficiency dataframe
     efficiency_df = pd.DataFrame({
         "station_name": start_counts.index,
@@ -284,119 +1393,384 @@ def calculate_station_efficiency(df: pd.DataFrame) -> pd.DataFrame:
     efficiency_df["utilization_score"] = 1 - abs(efficiency_df["net_flow"]) / efficiency_df["total_activity"]
     
     # Sort by total activity and get top 10
-    efficiency_df = efficiency_df.sort_values("total_activity", ascending=False).head(10)
+    efficiency_df = efficiency_df.sort_values(
+        "total_activity", ascending=False, kind="stable"
+    ).head(10)
     
     return efficiency_df[["station_name", "total_activity", "net_flow", "turnover_rate", "utilization_score"]]
 
 
-def calculate_neighborhood_stations(df: pd.DataFrame) -> dict:
-    """Calculate top stations per neighborhood and prepare map data for ALL neighborhoods"""
-    # Get all neighborhoods by activity (not just top 10)
-    neighborhood_activity = calculate_rides_by_neighborhood(df)
-    
-    # For each neighborhood, get top stations
-    neighborhood_stations = {}
-    
-    for neighborhood in neighborhood_activity.index:
-        # Filter trips starting in this neighborhood
-        neighborhood_trips = df[df["start_neighborhood"] == neighborhood]
-        
-        if len(neighborhood_trips) > 0:
-            # Get top stations in this neighborhood
-            top_stations = neighborhood_trips["start_station_name"].value_counts().head(3)
-            
-            neighborhood_stations[neighborhood] = {
-                "total_rides": int(neighborhood_activity.loc[neighborhood, "ride_count"]),
-                "ride_percent": float(neighborhood_activity.loc[neighborhood, "ride_percent"]),
-                "top_stations": [
+def station_slot_matrix(counts: pd.Series, stations: pd.Index) -> np.ndarray:
+    """Counts per (station, slot) laid out densely as stations x slots"""
+    matrix = np.zeros((len(stations), STATION_FLOW_SLOTS), dtype=np.int64)
+    rows = stations.get_indexer(counts.index.get_level_values(0))
+    slots = counts.index.get_level_values(1).to_numpy(dtype=np.int64)
+    matrix[rows, slots] = counts.to_numpy()
+    return matrix
+
+
+def calculate_station_flows(
+    departures: pd.Series, arrivals: pd.Series, top: int = STATION_FLOW_TOP
+) -> dict:
+    """Intraday inventory drift of the stations that run the deepest deficits
+
+    Drift is the cumulative arrivals minus departures over the slots of the day,
+    summed over every day of the period. A station's peak deficit is the largest
+    drop in its drift, over the window [start, end) of slots.
+    """
+    stations = departures.index.levels[0].union(arrivals.index.levels[0])
+    departed = station_slot_matrix(departures, stations)
+    arrived = station_slot_matrix(arrivals, stations)
+    drift = np.cumsum(arrived - departed, axis=1)
+
+    # Position p is the inventory after slot p - 1, starting from zero at midnight
+    inventory = np.concatenate([np.zeros((len(stations), 1), np.int64), drift], axis=1)
+    drawdown = np.maximum.accumulate(inventory, axis=1) - inventory
+    end = drawdown.argmax(axis=1)
+    deficit = drawdown[np.arange(len(stations)), end]
+    # The deficit starts from the highest inventory reached before it ends
+    positions = np.arange(STATION_FLOW_SLOTS + 1)
+    start = np.where(
+        positions <= end[:, None], inventory, np.iinfo(np.int64).min
+    ).argmax(axis=1)
+
+    # Stations are sorted by name, so ties keep a stable order
+    order = np.argsort(-deficit, kind="stable")[:top]
+    order = order[deficit[order] > 0]
+    return {
+        "slot_minutes": STATION_FLOW_SLOT_MINUTES,
+        "stations": stations[order].tolist(),
+        "departures": departed[order].tolist(),
+        "arrivals": arrived[order].tolist(),
+        "drift": drift[order].tolist(),
+        "deficit": deficit[order].tolist(),
+        "deficit_window": np.stack([start, end], axis=1)[order].tolist(),
+    }
+
+
+def density_cells(lat: pd.Series, lng: pd.Series) -> pd.Series:
+    """Id of the Web Mercator density grid cell each point falls in
+
+    Binning is uniform, as in np.histogram2d, so a point's cell is just the
+    floor of its projected coordinates over the cell size.
+    """
+    index = lat.index
+    lat = np.radians(lat.to_numpy(dtype=np.float64, na_value=np.nan))
+    lng = np.radians(lng.to_numpy(dtype=np.float64, na_value=np.nan))
+    x = WEB_MERCATOR_RADIUS * lng
+    y = WEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2))
+
+    column = np.floor((x + WEB_MERCATOR_HALF_WIDTH) / DENSITY_CELL_METERS)
+    row = np.floor((WEB_MERCATOR_HALF_WIDTH - y) / DENSITY_CELL_METERS)
+    return pd.Series(
+        pd.array(row * DENSITY_GRID_COLUMNS + column, dtype="Int64"), index=index
+    )
+
+
+def calculate_trip_density(origins: pd.Series, destinations: pd.Series) -> dict:
+    """Sparse density grids of trip starts and ends per membership and time of day
+
+    Cells are integer column and row offsets from the top-left cell seen in any
+    layer, whose corner is the Web Mercator origin; rows grow southward. Each
+    layer lists only its occupied cells, in cell id order.
+    """
+    counts = {"start": origins, "end": destinations}
+    cells = np.concatenate(
+        [end_counts.index.get_level_values(0).to_numpy(dtype=np.int64) for end_counts in counts.values()]
+    )
+    if len(cells) == 0:
+        return {"cell_meters": DENSITY_CELL_METERS, "origin": None, "layers": []}
+
+    rows, columns = np.divmod(cells, DENSITY_GRID_COLUMNS)
+    top, left = int(rows.min()), int(columns.min())
+
+    layers = []
+    for end, end_counts in counts.items():
+        end_counts = end_counts.sort_index()
+        layer_keys = end_counts.index.droplevel(0)
+        for membership in MEMBERSHIP_TYPES:
+            for time_of_day in TIME_OF_DAYS:
+                layer = end_counts[layer_keys == (membership, time_of_day)]
+                if layer.empty:
+                    continue
+
+                cell_rows, cell_columns = np.divmod(
+                    layer.index.get_level_values(0).to_numpy(dtype=np.int64),
+                    DENSITY_GRID_COLUMNS,
+                )
+                layers.append(
                     {
-                        "station_name": station,
-                        "ride_count": int(count),
-                        "ride_percent": round((count / len(neighborhood_trips) * 100), 2)
+                        "end": end,
+                        "member_casual": membership,
+                        "time_of_day": time_of_day,
+                        "x": (cell_columns - left).tolist(),
+                        "y": (cell_rows - top).tolist(),
+                        "count": layer.to_numpy(dtype=np.int64).tolist(),
                     }
-                    for station, count in top_stations.items()
-                ]
-            }
-        else:
-            # Still include neighborhoods with no trips
-            neighborhood_stations[neighborhood] = {
-                "total_rides": 0,
-                "ride_percent": 0.0,
-                "top_stations": []
+                )
+
+    return {
+        "cell_meters": DENSITY_CELL_METERS,
+        "origin": [
+            left * DENSITY_CELL_METERS - WEB_MERCATOR_HALF_WIDTH,
+            WEB_MERCATOR_HALF_WIDTH - top * DENSITY_CELL_METERS,
+        ],
+        "layers": layers,
+    }
+
+
+def calculate_neighborhood_flows(
+    flow_counts: pd.Series, top: int = NEIGHBORHOOD_FLOW_TOP
+) -> dict:
+    """Origin-destination matrices of neighborhoods per membership, in CSR form
+
+    Rows are origins and columns destinations, both indexing the sorted list of
+    neighborhoods; each membership has its own indptr, indices and counts.
+    """
+    origins = flow_counts.index.get_level_values(0)
+    destinations = flow_counts.index.get_level_values(1)
+    memberships = flow_counts.index.get_level_values(2)
+    neighborhoods = origins.union(destinations).unique().sort_values()
+    size = len(neighborhoods)
+    rows = neighborhoods.get_indexer(origins)
+    columns = neighborhoods.get_indexer(destinations)
+    counts = flow_counts.to_numpy(dtype=np.int64)
+
+    matrices, totals, top_flows = {}, {}, {}
+    for membership in MEMBERSHIP_TYPES:
+        selected = np.flatnonzero(memberships == membership)
+        # Sorting the COO entries by cell lays them out as CSR
+        order = selected[np.argsort(rows[selected] * size + columns[selected], kind="stable")]
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[order], minlength=size), out=indptr[1:])
+        matrices[membership] = {
+            "indptr": indptr.tolist(),
+            "indices": columns[order].tolist(),
+            "counts": counts[order].tolist(),
+        }
+        totals[membership] = {
+            "out": np.bincount(rows[order], counts[order], minlength=size).astype(np.int64).tolist(),
+            "in": np.bincount(columns[order], counts[order], minlength=size).astype(np.int64).tolist(),
+        }
+        top_flows[membership] = [
+            {"start_neighborhood": start, "end_neighborhood": end, "ride_count": int(count)}
+            for (start, end, _), count in sort_counts(flow_counts.iloc[selected]).head(top).items()
+        ]
+
+    return {
+        "neighborhoods": neighborhoods.tolist(),
+        "matrices": matrices,
+        "totals": totals,
+        "top_flows": top_flows,
+    }
+
+
+def top_k_by_group(
+    counts: pd.Series, k: int, group_levels: Union[int, str, list]
+) -> pd.Series:
+    """Top k entries of counts within every group, from a single sort of the whole table"""
+    return sort_counts(counts).groupby(level=group_levels, sort=False).head(k)
+
+
+def calculate_neighborhood_stations(
+    neighborhood_activity: pd.DataFrame, station_counts: pd.Series
+) -> dict:
+    """Calculate top stations per neighborhood and prepare map data for ALL neighborhoods"""
+    top_stations = top_k_by_group(station_counts, 3, group_levels=0)
+
+    # Every neighborhood with trips, even if none of them started at a station
+    neighborhood_stations = {
+        neighborhood: {
+            "total_rides": int(row.ride_count),
+            "ride_percent": float(row.ride_percent),
+            "top_stations": [],
+        }
+        for neighborhood, row in neighborhood_activity.iterrows()
+    }
+
+    for (neighborhood, station), count in top_stations.items():
+        stats = neighborhood_stations.get(neighborhood)
+        if stats is None:
+            continue
+
+        stats["top_stations"].append(
+            {
+                "station_name": station,
+                "ride_count": int(count),
+                "ride_percent": round((count / stats["total_rides"] * 100), 2)
             }
-    
+        )
+
     return neighborhood_stations
 
 
-def generate_svg_map_data(shapefile_fp: Path, neighborhood_stations: dict) -> str:
-    """Generate SVG map data from shapefile"""
+def quantize_ring(
+    ring: Any, origin: tuple[float, float], step: float
+) -> list[tuple[int, int]]:
+    """Snap a ring onto the integer map grid, dropping repeated points and the closing point"""
+    coords = shapely.get_coordinates(ring)
+    # y is flipped so the grid can be drawn as SVG user space directly
+    grid = np.rint((coords - origin) / (step, -step)).astype(np.int64)
+    keep = np.r_[True, np.any(np.diff(grid, axis=0) != 0, axis=1)]
+    points = [(int(x), int(y)) for x, y in grid[keep]]
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+
+    return points
+
+
+def find_junctions(rings: list[list[tuple[int, int]]]) -> set[tuple[int, int]]:
+    """Points where rings stop sharing a boundary, which arcs must be cut at"""
+    neighbors = {}
+    junctions = set()
+    for ring in rings:
+        for i, point in enumerate(ring):
+            pair = (ring[i - 1], ring[(i + 1) % len(ring)])
+            seen = neighbors.setdefault(point, pair)
+            if seen != pair and seen != pair[::-1]:
+                junctions.add(point)
+
+    return junctions
+
+
+def simplify_arc(points: list[tuple[int, int]], tolerance: float) -> list[tuple[int, int]]:
+    if len(points) <= 2:
+        return points
+
+    line = shapely.LineString(points)
+    # Closed arcs keep their topology so a ring can't collapse to a line
+    simplified = shapely.simplify(
+        line, tolerance, preserve_topology=points[0] == points[-1]
+    )
+    return [(int(x), int(y)) for x, y in shapely.get_coordinates(simplified)]
+
+
+def build_neighborhood_topology(
+    shapefile_fp: Path,
+    quantization: int = MAP_QUANTIZATION,
+    tolerance: float = MAP_SIMPLIFY_TOLERANCE,
+) -> dict:
+    """Simplified, quantized, delta-encoded TopoJSON of the neighborhood polygons
+
+    Boundaries shared by two neighborhoods become a single arc, so simplifying
+    each arc once can't open gaps or overlaps between neighbors.
+    """
     import geopandas as gpd
-    
-    # Read the shapefile
-    neighborhoods = gpd.read_file(shapefile_fp)
-    
-    # Convert to Web Mercator for consistent projection
-    neighborhoods_web = neighborhoods.to_crs(epsg=3857)
-    
-    # Get the bounding box
-    bounds = neighborhoods_web.total_bounds
-    width = bounds[2] - bounds[0]
-    height = bounds[3] - bounds[1]
-    
-    # Scale to fit in a reasonable SVG size (800x600)
-    scale = min(800 / width, 600 / height)
-    
-    # Generate SVG
-    svg_parts = []
-    svg_parts.append(
-        f'<svg width="800" height="600" viewBox="{bounds[0]} {bounds[1]} {width} {height}" '
-        'xmlns="http://www.w3.org/2000/svg" '
-        'style="transform: scaleY(-1); transform-origin: center;">'
-    )
-    svg_parts.append('<defs>')
-    svg_parts.append('<style>')
-    svg_parts.append('.neighborhood { fill: #1a1a1a; stroke: #63a4ff; stroke-width: 1; cursor: pointer; }')
-    svg_parts.append('.neighborhood:hover { fill: #2a2a2a; }')
-    svg_parts.append('.neighborhood.active { fill: #63a4ff; }')
-    svg_parts.append('.neighborhood-label { font-family: monospace; font-size: 8px; fill: #9c9c9c; pointer-events: none; }')
-    svg_parts.append('</style>')
-    svg_parts.append('</defs>')
-    # Add each neighborhood
-    for idx, row in neighborhoods_web.iterrows():
-        neighborhood_name = row['pri_neigh']
-        
-        # Get the geometry
-        geom = row.geometry
-        
-        if geom.geom_type == 'Polygon':
-            coords = list(geom.exterior.coords)
-            path_data = "M " + " L ".join([f"{x} {y}" for x, y in coords]) + " Z"
-        elif geom.geom_type == 'MultiPolygon':
-            paths = []
-            for poly in geom.geoms:
-                coords = list(poly.exterior.coords)
-                path_data = "M " + " L ".join([f"{x} {y}" for x, y in coords]) + " Z"
-                paths.append(path_data)
-            path_data = " ".join(paths)
-        else:
-            continue
-        
-        # Add the neighborhood polygon
-        svg_parts.append(f'<path class="neighborhood" d="{path_data}" data-neighborhood="{neighborhood_name}"/>')
-        
-        # Add label for neighborhoods with activity
-        if neighborhood_name in neighborhood_stations and neighborhood_stations[neighborhood_name]["total_rides"] > 0:
-            centroid = geom.centroid
-            svg_parts.append(f'<text x="{centroid.x}" y="{centroid.y}" class="neighborhood-label" text-anchor="middle">{neighborhood_name}</text>')
-    # Close the group before closing SVG
-    svg_parts.append('</svg>')
-    
-    return "\n".join(svg_parts)
 
+    # Web Mercator, matching the projection the SVG map has always used
+    neighborhoods = gpd.read_file(shapefile_fp).to_crs(epsg=3857)
+    minx, miny, maxx, maxy = neighborhoods.total_bounds
+    step = max(maxx - minx, maxy - miny) / (quantization - 1)
+    origin = (minx, maxy)
+
+    shapes = []
+    for name, geom in zip(neighborhoods["pri_neigh"], neighborhoods.geometry):
+        polygons = []
+        for polygon in getattr(geom, "geoms", [geom]):
+            rings = [
+                quantize_ring(ring, origin, step)
+                for ring in [polygon.exterior, *polygon.interiors]
+            ]
+            if len(rings[0]) >= 3:
+                polygons.append([ring for ring in rings if len(ring) >= 3])
+
+        centroid = shapely.get_coordinates(geom.centroid)[0]
+        label = np.rint((centroid - origin) / (step, -step)).astype(int).tolist()
+        shapes.append((name, polygons, label))
+
+    junctions = find_junctions(
+        [ring for _, polygons, _ in shapes for rings in polygons for ring in rings]
+    )
+    arcs: list[list[tuple[int, int]]] = []
+    arc_ids: dict[tuple, int] = {}
+
+    def add_arc(points: list[tuple[int, int]]) -> int:
+        key = tuple(points)
+        if key in arc_ids:
+            return arc_ids[key]
+        if key[::-1] in arc_ids:
+            return ~arc_ids[key[::-1]]
+
+        arc_ids[key] = len(arcs)
+        arcs.append(points)
+        return arc_ids[key]
+
+    def cut_ring(ring: list[tuple[int, int]]) -> list[int]:
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            # Start closed rings at their smallest point so a hole and the
+            # neighborhood filling it produce the same arc
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            return [add_arc(ring + ring[:1])]
+
+        ring = ring[cuts[0]:] + ring[: cuts[0]]
+        ring_arcs = []
+        current = ring[:1]
+        for point in ring[1:] + ring[:1]:
+            current.append(point)
+            if point in junctions:
+                ring_arcs.append(add_arc(current))
+                current = [point]
+
+        return ring_arcs
+
+    geometries = [
+        {
+            "type": "MultiPolygon",
+            "arcs": [[cut_ring(ring) for ring in rings] for rings in polygons],
+            "properties": {"name": name, "label": label},
+        }
+        for name, polygons, label in shapes
+    ]
 
-def calculate_rides_by_membership(df: pd.DataFrame) -> pd.DataFrame:
-    total_rides = len(df)
-    member_casual_counts = df["member_casual"].value_counts()
+    encoded_arcs = []
+    for arc in arcs:
+        arc = simplify_arc(arc, tolerance)
+        encoded_arcs.append(
+            [list(arc[0])]
+            + [[x1 - x0, y1 - y0] for (x0, y0), (x1, y1) in zip(arc, arc[1:])]
+        )
+
+    width = int(np.ceil((maxx - minx) / step)) + 1
+    height = int(np.ceil((maxy - miny) / step)) + 1
+    return {
+        "type": "Topology",
+        "bbox": [minx, miny, maxx, maxy],
+        "transform": {"scale": [step, -step], "translate": [minx, maxy]},
+        "size": [width, height],
+        "objects": {
+            "neighborhoods": {"type": "GeometryCollection", "geometries": geometries}
+        },
+        "arcs": encoded_arcs,
+    }
+
+
+def get_neighborhood_map(shapefile_fp: Path) -> dict:
+    """Neighborhood map topology, built once per shapefile and cached"""
+    map_fp = MAP_CACHE_DIR / (
+        f"{get_shapefile_hash(shapefile_fp)}"
+        f".q{MAP_QUANTIZATION}.t{MAP_SIMPLIFY_TOLERANCE}.json"
+    )
+    if map_fp.is_file():
+        with open(map_fp) as fd:
+            return json.load(fd)
+
+    print("Building neighborhood map...")
+    topology = build_neighborhood_topology(shapefile_fp)
+    map_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = map_fp.with_suffix(".tmp")
+    with open(tmp_fp, "w") as fd:
+        json.dump(topology, fd, separators=(",", ":"))
+
+    tmp_fp.replace(map_fp)
+    return topology
+
+
+def calculate_rides_by_membership(
+    member_casual_counts: pd.Series, total_rides: int
+) -> pd.DataFrame:
+    member_casual_counts = sort_counts(member_casual_counts)
 
     member_casual_percentages = (member_casual_counts / total_rides) * 100
 
@@ -406,10 +1780,10 @@ def calculate_rides_by_membership(df: pd.DataFrame) -> pd.DataFrame:
     )
 
 
-def calculate_rides_by_neighborhood(df: pd.DataFrame) -> pd.DataFrame:
-    total_rides = len(df)
-
-    start_neighborhood_counts = df["start_neighborhood"].value_counts()
+def calculate_rides_by_neighborhood(
+    start_neighborhood_counts: pd.Series, total_rides: int
+) -> pd.DataFrame:
+    start_neighborhood_counts = sort_counts(start_neighborhood_counts)
 
     start_neighborhood_percentages = (start_neighborhood_counts / total_rides) * 100
 
@@ -421,6 +1795,35 @@ def calculate_rides_by_neighborhood(df: pd.DataFrame) -> pd.DataFrame:
     )
 
 
+def calculate_distribution(
+    bucket_counts: pd.Series,
+    bin_counts: pd.Series,
+    edges: list[int],
+    to_value: Callable[[Any], Any] = lambda value: value,
+) -> dict:
+    """Quantiles and a histogram of a trip value per membership and rideable type"""
+    groups = []
+    for group, counts in bucket_counts.groupby(level=[0, 1], sort=True):
+        counts = counts.droplevel([0, 1]).sort_index()
+        cumulative = counts.cumsum().to_numpy()
+        ride_count = int(cumulative[-1])
+        values = quantile_bucket_values(counts.index.to_numpy())
+
+        stats = dict(zip(bucket_counts.index.names[:2], group))
+        stats["ride_count"] = ride_count
+        for q in QUANTILES:
+            # First bucket holding the trip at rank q * (n - 1)
+            i = np.searchsorted(cumulative, q * (ride_count - 1), side="right")
+            stats[f"p{round(q * 100)}"] = round(float(to_value(values[i])), 2)
+
+        # Trips with a value always have both a bucket and a bin
+        histogram = bin_counts.xs(group, level=[0, 1])
+        stats["histogram"] = [int(histogram.get(i, 0)) for i in range(len(edges))]
+        groups.append(stats)
+
+    return {"edges": [to_value(edge) for edge in edges], "groups": groups}
+
+
 def df_to_json(df: Union[pd.DataFrame, pd.Series]) -> Any:
     index_name = df.index.name
     df_reset = df.reset_index()
@@ -429,90 +1832,300 @@ def df_to_json(df: Union[pd.DataFrame, pd.Series]) -> Any:
     return json.loads(df_reset.to_json(orient="records"))
 
 
-def generate_analysis_json(
-    conn: sqlite3.Connection, as_of_month: str, shapefile_fp: Path
-) -> Path:
-    print("Reading trips from SQLite...")
-    result = {"meta": {"as_of": as_of_month}, "stats": {}}
-
-    df = pd.read_sql("SELECT * FROM trips", conn)
+def derive_trip_features(df: pd.DataFrame) -> pd.DataFrame:
+    """Derive every per-trip feature except the neighborhood lookups"""
+    # Whole milliseconds, so duration sums are exact in any order and in any engine
+    df["ride_duration_ms"] = (df["ended_at"] - df["started_at"]) / pd.Timedelta(
+        milliseconds=1
+    )
+    df["ride_duration"] = df["ride_duration_ms"] / 60_000
+    df["hour"] = df["started_at"].dt.hour
+    df["weekday"] = df["started_at"].dt.weekday
+    df["time_of_day"] = categorize_time_of_day(df["hour"])
+    df["start_slot"] = day_slots(df["started_at"])
+    df["end_slot"] = day_slots(df["ended_at"])
+    df["revenue_cents"] = calculate_revenue_cents(df)
+    for column, edges in (
+        ("ride_duration", DURATION_HISTOGRAM_EDGES),
+        ("revenue_cents", REVENUE_HISTOGRAM_EDGES),
+    ):
+        df[f"{column}_bucket"] = quantile_buckets(df[column])
+        df[f"{column}_bin"] = histogram_bins(df[column], edges)
+    df["distance_m"] = haversine_meters(df)
+    df["speed_kmh"] = trip_speeds_kmh(df["distance_m"], df["ride_duration_ms"])
+    df["implausible_trip"] = flag_implausible_trips(df)
+    for column, edges in (
+        ("distance_m", DISTANCE_HISTOGRAM_EDGES),
+        ("speed_kmh", SPEED_HISTOGRAM_EDGES),
+    ):
+        plausible = df[column].where(~df["implausible_trip"])
+        df[f"{column}_bucket"] = quantile_buckets(plausible)
+        df[f"{column}_bin"] = histogram_bins(plausible, edges)
+    # Missing stations compare unequal, so they count toward the route total
+    df["non_round_trip"] = df["start_station_name"] != df["end_station_name"]
+    return df
 
-    print("Processing trip data...")
-    df["started_at"] = pd.to_datetime(df["started_at"], errors="coerce")
-    df["ended_at"] = pd.to_datetime(df["ended_at"], errors="coerce")
-    df["ride_duration"] = (df["ended_at"] - df["started_at"]).dt.total_seconds() / 60
-    df["time_of_day"] = df["started_at"].dt.hour.apply(categorize_time_of_day)
-    df["estimated_revenue"] = calculate_revenue_vectorized(df)
-    total_rides = len(df)
 
+def enrich_trips(
+    df: pd.DataFrame,
+    shapefile_fp: Path,
+    grid_precision: int = NEIGHBORHOOD_GRID_PRECISION,
+) -> pd.DataFrame:
+    """Derive the per-trip features every stat aggregates over"""
+    df = derive_trip_features(df)
     print("Assigning neighborhoods to trips...")
-    df = get_neighborhoods(df, shapefile_fp)
+    return get_neighborhoods(df, shapefile_fp, grid_precision)
+
+
+# Reductions that approximate counts per group in bounded memory
+SKETCH_FUNCS = ("space_saving", "count_min")
+# Reductions that fill a table of their own, with their own layout
+TABLE_FUNCS = (*SKETCH_FUNCS, "cube")
+
+
+@dataclass(frozen=True)
+class Reduction:
+    """A reduction of one column (or the row count) grouped by a set of keys"""
+
+    keys: tuple[str, ...] = ()
+    column: Optional[str] = None
+    func: str = "size"
+    # Name of a boolean feature column selecting the rows to reduce
+    where: Optional[str] = None
+
+    @property
+    def table(self) -> str:
+        name = "+".join(self.keys) if self.keys else "totals"
+        if self.where:
+            name = f"{name}.{self.where}"
+        # Sketches and cubes have their own layout, so never share a table
+        return f"{name}.{self.func}" if self.func in TABLE_FUNCS else name
+
+    @property
+    def output(self) -> str:
+        if self.func == "size" or self.func in SKETCH_FUNCS:
+            return "ride_count"
+        return f"{self.column}_{self.func}"
+
+
+@dataclass(frozen=True)
+class Stat:
+    """A published stat: the reductions it needs and how to format them"""
+
+    name: str
+    reductions: tuple[Reduction, ...]
+    format: Callable[[dict[str, pd.DataFrame]], Any]
+
+
+def count_by(*keys: str, where: Optional[str] = None) -> Reduction:
+    return Reduction(keys, where=where)
+
+
+def sketch_by(*keys: str, func: str, where: Optional[str] = None) -> Reduction:
+    return Reduction(keys, func=func, where=where)
+
+
+def reduce_by(*keys: str, column: str, func: str) -> Reduction:
+    return Reduction(keys, column, func)
+
+
+TOTAL_RIDES = count_by()
+TOTAL_REVENUE = reduce_by(column="revenue_cents", func="sum")
+DURATION_BUCKET_COUNTS = count_by("member_casual", "rideable_type", "ride_duration_bucket")
+DURATION_BIN_COUNTS = count_by("member_casual", "rideable_type", "ride_duration_bin")
+REVENUE_BUCKET_COUNTS = count_by("member_casual", "rideable_type", "revenue_cents_bucket")
+REVENUE_BIN_COUNTS = count_by("member_casual", "rideable_type", "revenue_cents_bin")
+DISTANCE_BUCKET_COUNTS = count_by("member_casual", "rideable_type", "distance_m_bucket")
+DISTANCE_BIN_COUNTS = count_by("member_casual", "rideable_type", "distance_m_bin")
+SPEED_BUCKET_COUNTS = count_by("member_casual", "rideable_type", "speed_kmh_bucket")
+SPEED_BIN_COUNTS = count_by("member_casual", "rideable_type", "speed_kmh_bin")
+IMPLAUSIBLE_TRIPS = reduce_by(
+    "member_casual", "rideable_type", column="implausible_trip", func="sum"
+)
+
+
+ROLLUP_CUBE = Reduction(ROLLUP_CUBE_KEYS, func="cube")
+
+
+def get_reduction(tables: dict[str, pd.DataFrame], reduction: Reduction) -> pd.Series:
+    return tables[reduction.table][reduction.output]
+
+
+def get_total(tables: dict[str, pd.DataFrame], reduction: Reduction) -> Any:
+    return get_reduction(tables, reduction).sum()
+
+
+def format_neighborhood_activity(tables: dict[str, pd.DataFrame]) -> Any:
+    return df_to_json(
+        calculate_rides_by_neighborhood(
+            get_reduction(tables, count_by("start_neighborhood")),
+            get_total(tables, TOTAL_RIDES),
+        ).head(10)
+    )
+
+
+def format_station_activity(tables: dict[str, pd.DataFrame]) -> Any:
+    station_activity = calculate_station_activity(
+        get_reduction(tables, count_by("start_station_name")),
+        get_reduction(tables, count_by("end_station_name")),
+        get_total(tables, TOTAL_RIDES),
+    )
+    return json.loads(station_activity.to_json(orient="records"))
+
+
+def format_popular_routes(tables: dict[str, pd.DataFrame]) -> Any:
+    popular_routes = calculate_popular_routes(
+        get_reduction(
+            tables,
+            count_by("start_station_name", "end_station_name", where="non_round_trip"),
+        ),
+        get_total(tables, reduce_by(column="non_round_trip", func="sum")),
+    )
+    return json.loads(popular_routes.to_json(orient="records"))
+
 
-    # Timed stat calculations
-    t0 = time.time()
-    print("Calculating neighborhood activity...")
-    result["stats"]["neighborhood_activity"] = df_to_json(
-        calculate_rides_by_neighborhood(df).head(10)
+def format_popular_routes_from_sketches(tables: dict[str, pd.DataFrame]) -> Any:
+    popular_routes = calculate_popular_routes_from_sketches(
+        tables[ROUTE_HEAVY_HITTERS.table],
+        tables[ROUTE_COUNT_MIN.table],
+        get_total(tables, reduce_by(column="non_round_trip", func="sum")),
     )
-    print(f"  Done in {time.time() - t0:.2f}s")
+    return json.loads(popular_routes.to_json(orient="records"))
 
-    t0 = time.time()
-    print("Calculating station activity...")
-    station_activity = calculate_station_activity(df)
-    result["stats"]["station_activity"] = json.loads(
-        station_activity.to_json(orient="records")
+
+def format_peak_hours(tables: dict[str, pd.DataFrame]) -> Any:
+    peak_hours = calculate_peak_hours(tables["hour"], get_total(tables, TOTAL_RIDES))
+    return json.loads(peak_hours.to_json(orient="records"))
+
+
+def format_station_efficiency(tables: dict[str, pd.DataFrame]) -> Any:
+    station_efficiency = calculate_station_efficiency(
+        get_reduction(tables, count_by("start_station_name")),
+        get_reduction(tables, count_by("end_station_name")),
+        get_total(tables, TOTAL_RIDES),
+    )
+    return json.loads(station_efficiency.to_json(orient="records"))
+
+
+def format_station_flows(tables: dict[str, pd.DataFrame]) -> Any:
+    return calculate_station_flows(
+        get_reduction(tables, count_by("start_station_name", "start_slot")),
+        get_reduction(tables, count_by("end_station_name", "end_slot")),
     )
-    print(f"  Done in {time.time() - t0:.2f}s")
 
-    t0 = time.time()
-    print("Calculating popular routes...")
-    popular_routes = calculate_popular_routes(df)
-    result["stats"]["popular_routes"] = json.loads(
-        popular_routes.to_json(orient="records")
+
+def format_trip_density(tables: dict[str, pd.DataFrame]) -> Any:
+    return calculate_trip_density(
+        get_reduction(tables, count_by("start_cell", "member_casual", "time_of_day")),
+        get_reduction(tables, count_by("end_cell", "member_casual", "time_of_day")),
+    )
+
+
+def format_neighborhood_flows(tables: dict[str, pd.DataFrame]) -> Any:
+    return calculate_neighborhood_flows(
+        get_reduction(
+            tables, count_by("start_neighborhood", "end_neighborhood", "member_casual")
+        )
+    )
+
+
+def encode_typed_array(values: np.ndarray) -> dict:
+    """Whole numbers as base64 of the narrowest little-endian typed array holding them"""
+    for dtype in ROLLUP_CUBE_DTYPES:
+        limits = np.iinfo(dtype) if np.dtype(dtype).kind in "iu" else np.finfo(dtype)
+        if not len(values) or limits.min <= values.min() and values.max() <= limits.max:
+            break
+
+    data = values.astype(np.dtype(dtype).newbyteorder("<")).tobytes()
+    return {"dtype": dtype, "data": base64.b64encode(data).decode("ascii")}
+
+
+def format_rollup_cube(tables: dict[str, pd.DataFrame]) -> Any:
+    """The cube's non-empty cells as little-endian typed arrays
+
+    Cells are the row-major indexes of the cells over the dimensions, sorted and
+    delta encoded; each measure lists its values in the same order. Labels of
+    each dimension are sorted, with a null label last for trips missing that
+    key. Every measure is a whole number, durations being rounded to seconds.
+    """
+    cube = tables[ROLLUP_CUBE.table]
+    dimensions, positions = [], []
+    for level, name in enumerate(cube.index.names):
+        values = cube.index.get_level_values(level)
+        missing = missing_cube_keys(values)
+        labels = values[~missing].unique().sort_values()
+        published = labels.tolist()
+        if missing.any():
+            labels = labels.append(values[missing][:1])
+            published.append(None)
+
+        positions.append(labels.get_indexer(values))
+        dimensions.append({"name": name, "labels": published})
+
+    shape = [len(dimension["labels"]) for dimension in dimensions]
+    cells = np.ravel_multi_index(positions, shape)
+    order = np.argsort(cells)
+    measures = {
+        "ride_count": cube["ride_count"],
+        "ride_duration_s_sum": cube["ride_duration_ms_sum"] / 1000,
+        "revenue_cents_sum": cube["revenue_cents_sum"],
+    }
+    return {
+        "dimensions": dimensions,
+        "shape": shape,
+        "cells": encode_typed_array(np.diff(cells[order], prepend=0)),
+        "measures": {
+            name: encode_typed_array(np.rint(values.to_numpy(dtype=np.float64)[order]))
+            for name, values in measures.items()
+        },
+    }
+
+
+def format_neighborhood_stations(tables: dict[str, pd.DataFrame]) -> Any:
+    neighborhood_activity = calculate_rides_by_neighborhood(
+        get_reduction(tables, count_by("start_neighborhood")),
+        get_total(tables, TOTAL_RIDES),
+    )
+    return calculate_neighborhood_stations(
+        neighborhood_activity,
+        get_reduction(tables, count_by("start_neighborhood", "start_station_name")),
     )
-    print(f"  Done in {time.time() - t0:.2f}s")
 
-    t0 = time.time()
-    print("Calculating peak hours...")
-    peak_hours = calculate_peak_hours(df)
-    result["stats"]["peak_hours"] = json.loads(
-        peak_hours.to_json(orient="records")
+
+def format_average_ride_duration(tables: dict[str, pd.DataFrame]) -> Any:
+    membership = tables["member_casual"].sort_index()
+    average_ride_duration = (
+        membership["ride_duration_ms_sum"] / membership["ride_duration_ms_count"] / 60_000
     )
-    print(f"  Done in {time.time() - t0:.2f}s")
+    return df_to_json(average_ride_duration.rename("ride_duration"))
+
 
-    t0 = time.time()
-    print("Calculating station efficiency...")
-    station_efficiency = calculate_station_efficiency(df)
-    result["stats"]["station_efficiency"] = json.loads(
-        station_efficiency.to_json(orient="records")
+def format_rides_by_membership(tables: dict[str, pd.DataFrame]) -> Any:
+    return df_to_json(
+        calculate_rides_by_membership(
+            get_reduction(tables, count_by("member_casual")),
+            get_total(tables, TOTAL_RIDES),
+        )
     )
-    print(f"  Done in {time.time() - t0:.2f}s")
 
-    t0 = time.time()
-    print("Calculating neighborhood stations and generating SVG map...")
-    neighborhood_stations = calculate_neighborhood_stations(df)
-    result["stats"]["neighborhood_stations"] = neighborhood_stations
-    svg_map = generate_svg_map_data(shapefile_fp, neighborhood_stations)
-    result["stats"]["neighborhood_svg_map"] = svg_map
-    print(f"  Done in {time.time() - t0:.2f}s")
 
-    t0 = time.time()
-    print("Calculating ride duration and revenue stats...")
-    average_ride_duration = df.groupby("member_casual")["ride_duration"].mean()
-    result["stats"]["average_ride_duration"] = df_to_json(average_ride_duration)
+def format_total_estimated_revenue(tables: dict[str, pd.DataFrame]) -> Any:
+    return float(cents_to_dollars(get_total(tables, TOTAL_REVENUE)))
 
-    rides_by_membership = calculate_rides_by_membership(df)
-    result["stats"]["rides_by_membership"] = df_to_json(rides_by_membership)
 
-    total_estimated_revenue = df["estimated_revenue"].sum()
-    result["stats"]["total_estimated_revenue"] = total_estimated_revenue
+def format_average_revenue_per_trip(tables: dict[str, pd.DataFrame]) -> Any:
+    membership = tables["member_casual"].sort_index()
+    average_revenue_per_trip = cents_to_dollars(
+        membership["revenue_cents_sum"] / membership["revenue_cents_count"]
+    )
+    return df_to_json(average_revenue_per_trip.rename("estimated_revenue"))
 
-    average_revenue_per_trip = df.groupby("member_casual")["estimated_revenue"].mean()
-    result["stats"]["average_revenue_per_trip"] = df_to_json(average_revenue_per_trip)
 
-    total_revenue_by_type = df.groupby("member_casual")["estimated_revenue"].sum()
+def format_revenue_by_membership(tables: dict[str, pd.DataFrame]) -> Any:
+    revenue_by_type = tables["member_casual"]["revenue_cents_sum"].sort_index()
+    total_revenue_by_type = cents_to_dollars(revenue_by_type)
     revenue_percentage_by_membership = (
-        total_revenue_by_type / total_estimated_revenue
+        revenue_by_type / get_total(tables, TOTAL_REVENUE)
     ) * 100
 
     # Combine total revenue and percentage into a DataFrame
@@ -522,81 +2135,1589 @@ def generate_analysis_json(
             "percent_revenue": revenue_percentage_by_membership,
         }
     )
-    result["stats"]["revenue_by_membership"] = df_to_json(revenue_stats)
-    print(f"  Done in {time.time() - t0:.2f}s")
+    return df_to_json(revenue_stats)
 
-    t0 = time.time()
-    print("Calculating time of day stats...")
-    trip_counts_by_time_of_day = df["time_of_day"].value_counts()
 
-    trip_percentage_by_time_of_day = (trip_counts_by_time_of_day / total_rides) * 100
+def format_trips_by_time_of_day(tables: dict[str, pd.DataFrame]) -> Any:
+    trip_counts_by_time_of_day = sort_counts(
+        get_reduction(tables, count_by("time_of_day"))
+    )
+
+    trip_percentage_by_time_of_day = (
+        trip_counts_by_time_of_day / get_total(tables, TOTAL_RIDES)
+    ) * 100
     time_of_day_stats = pd.DataFrame(
         {
             "ride_count": trip_counts_by_time_of_day,
             "ride_percent": trip_percentage_by_time_of_day,
         }
     )
-    result["stats"]["trips_by_time_of_day"] = df_to_json(time_of_day_stats)
+    return df_to_json(time_of_day_stats)
+
 
-    revenue_by_time_of_day = df.groupby("time_of_day")["estimated_revenue"].sum()
+def format_revenue_by_time_of_day(tables: dict[str, pd.DataFrame]) -> Any:
+    revenue_by_time_of_day = tables["time_of_day"]["revenue_cents_sum"].sort_index()
 
-    revenue_percentage = (revenue_by_time_of_day / total_estimated_revenue) * 100
+    revenue_percentage = (revenue_by_time_of_day / get_total(tables, TOTAL_REVENUE)) * 100
 
     revenue_stats = pd.DataFrame(
         {
-            "total_revenue": revenue_by_time_of_day,
+            "total_revenue": cents_to_dollars(revenue_by_time_of_day),
             "revenue_percentage": revenue_percentage,
         }
     )
-    result["stats"]["revenue_by_time_of_date"] = df_to_json(revenue_stats)
-    print(f"  Done in {time.time() - t0:.2f}s")
+    return df_to_json(revenue_stats)
 
-    outfile = Path(OUTFILE_NAME)
-    print(f"Writing output to {outfile}...")
-    with open(outfile, "w") as fd:
-        fd.write(json.dumps(result))
 
-    print("Done writing output.")
+def format_ride_duration_distribution(tables: dict[str, pd.DataFrame]) -> Any:
+    return calculate_distribution(
+        get_reduction(tables, DURATION_BUCKET_COUNTS),
+        get_reduction(tables, DURATION_BIN_COUNTS),
+        DURATION_HISTOGRAM_EDGES,
+    )
+
+
+def format_revenue_distribution(tables: dict[str, pd.DataFrame]) -> Any:
+    return calculate_distribution(
+        get_reduction(tables, REVENUE_BUCKET_COUNTS),
+        get_reduction(tables, REVENUE_BIN_COUNTS),
+        REVENUE_HISTOGRAM_EDGES,
+        cents_to_dollars,
+    )
+
+
+def format_trip_distance_distribution(tables: dict[str, pd.DataFrame]) -> Any:
+    return calculate_distribution(
+        get_reduction(tables, DISTANCE_BUCKET_COUNTS),
+        get_reduction(tables, DISTANCE_BIN_COUNTS),
+        DISTANCE_HISTOGRAM_EDGES,
+        meters_to_kilometers,
+    )
+
+
+def format_trip_speed_distribution(tables: dict[str, pd.DataFrame]) -> Any:
+    return calculate_distribution(
+        get_reduction(tables, SPEED_BUCKET_COUNTS),
+        get_reduction(tables, SPEED_BIN_COUNTS),
+        SPEED_HISTOGRAM_EDGES,
+    )
+
+
+def format_implausible_trips(tables: dict[str, pd.DataFrame]) -> Any:
+    trips = pd.DataFrame(
+        {
+            "ride_count": get_reduction(tables, count_by("member_casual", "rideable_type")),
+            "implausible_count": get_reduction(tables, IMPLAUSIBLE_TRIPS),
+        }
+    ).sort_index()
+    trips["implausible_percent"] = trips["implausible_count"] / trips["ride_count"] * 100
+    return json.loads(trips.reset_index().to_json(orient="records"))
+
+
+# Every published stat, in output order. Stats only declare the grouped
+# reductions they need; plan_aggregations computes each distinct grouping once.
+STATS = [
+    Stat(
+        "neighborhood_activity",
+        (count_by("start_neighborhood"), TOTAL_RIDES),
+        format_neighborhood_activity,
+    ),
+    Stat(
+        "station_activity",
+        (count_by("start_station_name"), count_by("end_station_name"), TOTAL_RIDES),
+        format_station_activity,
+    ),
+    Stat(
+        "popular_routes",
+        (
+            count_by("start_station_name", "end_station_name", where="non_round_trip"),
+            reduce_by(column="non_round_trip", func="sum"),
+        ),
+        format_popular_routes,
+    ),
+    Stat(
+        "peak_hours",
+        (
+            count_by("hour"),
+            reduce_by("hour", column="revenue_cents", func="sum"),
+            reduce_by("hour", column="revenue_cents", func="count"),
+            TOTAL_RIDES,
+        ),
+        format_peak_hours,
+    ),
+    Stat(
+        "station_efficiency",
+        (count_by("start_station_name"), count_by("end_station_name"), TOTAL_RIDES),
+        format_station_efficiency,
+    ),
+    Stat(
+        "station_flows",
+        (
+            count_by("start_station_name", "start_slot"),
+            count_by("end_station_name", "end_slot"),
+        ),
+        format_station_flows,
+    ),
+    Stat(
+        "neighborhood_stations",
+        (
+            count_by("start_neighborhood"),
+            count_by("start_neighborhood", "start_station_name"),
+            TOTAL_RIDES,
+        ),
+        format_neighborhood_stations,
+    ),
+    Stat(
+        "average_ride_duration",
+        (
+            reduce_by("member_casual", column="ride_duration_ms", func="sum"),
+            reduce_by("member_casual", column="ride_duration_ms", func="count"),
+        ),
+        format_average_ride_duration,
+    ),
+    Stat(
+        "rides_by_membership",
+        (count_by("member_casual"), TOTAL_RIDES),
+        format_rides_by_membership,
+    ),
+    Stat("total_estimated_revenue", (TOTAL_REVENUE,), format_total_estimated_revenue),
+    Stat(
+        "average_revenue_per_trip",
+        (
+            reduce_by("member_casual", column="revenue_cents", func="sum"),
+            reduce_by("member_casual", column="revenue_cents", func="count"),
+        ),
+        format_average_revenue_per_trip,
+    ),
+    Stat(
+        "revenue_by_membership",
+        (reduce_by("member_casual", column="revenue_cents", func="sum"), TOTAL_REVENUE),
+        format_revenue_by_membership,
+    ),
+    Stat(
+        "trips_by_time_of_day",
+        (count_by("time_of_day"), TOTAL_RIDES),
+        format_trips_by_time_of_day,
+    ),
+    Stat(
+        "revenue_by_time_of_date",
+        (reduce_by("time_of_day", column="revenue_cents", func="sum"), TOTAL_REVENUE),
+        format_revenue_by_time_of_day,
+    ),
+    Stat(
+        "ride_duration_distribution",
+        (DURATION_BUCKET_COUNTS, DURATION_BIN_COUNTS),
+        format_ride_duration_distribution,
+    ),
+    Stat(
+        "revenue_distribution",
+        (REVENUE_BUCKET_COUNTS, REVENUE_BIN_COUNTS),
+        format_revenue_distribution,
+    ),
+    Stat(
+        "trip_distance_distribution",
+        (DISTANCE_BUCKET_COUNTS, DISTANCE_BIN_COUNTS),
+        format_trip_distance_distribution,
+    ),
+    Stat(
+        "trip_speed_distribution",
+        (SPEED_BUCKET_COUNTS, SPEED_BIN_COUNTS),
+        format_trip_speed_distribution,
+    ),
+    Stat(
+        "implausible_trips",
+        (count_by("member_casual", "rideable_type"), IMPLAUSIBLE_TRIPS),
+        format_implausible_trips,
+    ),
+    Stat("rollup_cube", (ROLLUP_CUBE,), format_rollup_cube),
+    Stat(
+        "trip_density",
+        (
+            count_by("start_cell", "member_casual", "time_of_day"),
+            count_by("end_cell", "member_casual", "time_of_day"),
+        ),
+        format_trip_density,
+    ),
+    Stat(
+        "neighborhood_flows",
+        (count_by("start_neighborhood", "end_neighborhood", "member_casual"),),
+        format_neighborhood_flows,
+    ),
+]
+
+
+ROUTE_HEAVY_HITTERS = sketch_by(
+    "start_station_name", "end_station_name", func="space_saving", where="non_round_trip"
+)
+ROUTE_COUNT_MIN = sketch_by(
+    "start_station_name", "end_station_name", func="count_min", where="non_round_trip"
+)
+
+# Streaming mode swaps stats over unbounded groupings for sketched ones
+STREAMING_STATS = [
+    {
+        "popular_routes": Stat(
+            "popular_routes",
+            (
+                ROUTE_HEAVY_HITTERS,
+                ROUTE_COUNT_MIN,
+                reduce_by(column="non_round_trip", func="sum"),
+            ),
+            format_popular_routes_from_sketches,
+        ),
+    }.get(stat.name, stat)
+    for stat in STATS
+]
+
+
+def plan_aggregations(stats: list[Stat]) -> dict[str, list[Reduction]]:
+    """Group the reductions of every stat by the table (grouping) they reduce into"""
+    plan: dict[str, list[Reduction]] = {}
+    for stat in stats:
+        for reduction in stat.reductions:
+            table_reductions = plan.setdefault(reduction.table, [])
+            if reduction not in table_reductions:
+                table_reductions.append(reduction)
+
+    return plan
+
+
+def has_key_codes(column: pd.Series) -> bool:
+    return isinstance(column.dtype, pd.CategoricalDtype) or column.name in KEY_DOMAINS
+
+
+def get_key_codes(column: pd.Series) -> tuple[np.ndarray, pd.Index]:
+    """Integer codes of a key and the labels they index, -1 where it is missing"""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), column.cat.categories.astype(str)
+
+    codes = column.to_numpy(dtype=np.int64, na_value=-1)
+    return codes, pd.RangeIndex(KEY_DOMAINS[column.name])
+
+
+def count_by_codes(
+    df: pd.DataFrame, keys: tuple[str, ...], where: Optional[str] = None
+) -> pd.Series:
+    """Count rows per group of coded keys with a bincount over their combined codes
+
+    Keys are categorical, or integers of a KEY_DOMAINS domain. Group names are
+    never materialized per row: the result is indexed by the keys' labels, so
+    only the rows a stat publishes are ever decoded. Rows outside where are
+    masked out of the codes rather than copied out of df.
+    """
+    codes, categories = zip(*(get_key_codes(df[key]) for key in keys))
+    shape = tuple(len(level) for level in categories)
+    # Like groupby, rows with a missing key are dropped
+    valid = np.logical_and.reduce([code >= 0 for code in codes])
+    if where:
+        valid &= df[where].to_numpy(dtype=bool)
+    combined = np.ravel_multi_index([code[valid] for code in codes], shape)
+
+    if math.prod(shape) <= max(len(combined), 1 << 20):
+        counts = np.bincount(combined, minlength=math.prod(shape))
+        groups = np.flatnonzero(counts)
+        counts = counts[groups]
+    else:
+        # Too many possible groups for a dense table, so only count the ones seen
+        groups, counts = np.unique(combined, return_counts=True)
+
+    group_codes = np.unravel_index(groups, shape)
+    if len(keys) == 1:
+        index = categories[0].take(group_codes[0]).rename(keys[0])
+    else:
+        index = pd.MultiIndex(levels=categories, codes=group_codes, names=keys)
+
+    return pd.Series(counts, index=index)
+
+
+def build_cube(df: pd.DataFrame, keys: tuple[str, ...]) -> pd.DataFrame:
+    """Trip count, duration and revenue per combination of keys, in one bincount pass
+
+    Unlike a groupby, rows missing a key are kept, under MISSING_KEY (or
+    MISSING_INT_KEY for integer keys), so every coarser grouping projected from
+    the cube counts exactly the rows it would have counted itself.
+    """
+    levels, codes = [], []
+    for key in keys:
+        column = df[key]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            key_codes, labels = column.cat.codes.to_numpy(), column.cat.categories.astype(str)
+            missing_label = MISSING_KEY
+        else:
+            # A trip without a start makes hour float, but its labels are whole hours
+            key_codes, labels = pd.factorize(column, sort=True)
+            labels = pd.Index(labels.astype(np.int64))
+            missing_label = MISSING_INT_KEY
+
+        key_codes = key_codes.astype(np.int64)
+        missing = key_codes < 0
+        if missing.any():
+            labels = labels.append(pd.Index([missing_label], dtype=labels.dtype))
+            key_codes[missing] = len(labels) - 1
+        levels.append(labels)
+        codes.append(key_codes)
+
+    shape = tuple(len(level) for level in levels)
+    size = math.prod(shape)
+    cells = np.ravel_multi_index(codes, shape)
+
+    columns = {"ride_count": np.bincount(cells, minlength=size)}
+    for measure in ROLLUP_CUBE_MEASURES:
+        values = df[measure].to_numpy(dtype=np.float64, na_value=np.nan)
+        present = ~np.isnan(values)
+        columns[f"{measure}_sum"] = np.bincount(
+            cells, np.where(present, values, 0), minlength=size
+        )
+        columns[f"{measure}_count"] = np.bincount(
+            cells, present, minlength=size
+        ).astype(np.int64)
+
+    groups = np.flatnonzero(columns["ride_count"])
+    index = pd.MultiIndex(
+        levels=levels, codes=np.unravel_index(groups, shape), names=keys
+    )
+    return pd.DataFrame(
+        {name: values[groups] for name, values in columns.items()}, index=index
+    )
+
+
+def is_cube_projection(reduction: Reduction) -> bool:
+    """Whether a reduction can be read off the rollup cube instead of the trips"""
+    return (
+        reduction.where is None
+        and set(reduction.keys) <= {*ROLLUP_CUBE_KEYS, "time_of_day"}
+        and (
+            reduction.func == "size"
+            or (
+                reduction.func in ("sum", "count")
+                and reduction.column in ROLLUP_CUBE_MEASURES
+            )
+        )
+    )
+
+
+def missing_cube_keys(values: Any) -> np.ndarray:
+    """Which cube labels stand for trips missing the key"""
+    missing = MISSING_KEY if values.dtype == object else MISSING_INT_KEY
+    return np.asarray(values == missing)
+
+
+def project_cube(cube: pd.DataFrame, reductions: list[Reduction]) -> pd.DataFrame:
+    """The table of reductions over a subset of the cube's keys, summed out of the cube
+
+    Cells missing one of the table's keys are dropped, as a groupby would drop
+    their rows; time of day is derived from the hour.
+    """
+    keys = list(reductions[0].keys)
+    outputs = [reduction.output for reduction in reductions]
+    cells = cube.reset_index()
+    for key in keys:
+        source = "hour" if key == "time_of_day" else key
+        cells = cells[~missing_cube_keys(cells[source])]
+    if "time_of_day" in keys:
+        cells["time_of_day"] = np.asarray(
+            categorize_time_of_day(cells["hour"].astype(np.int64)), dtype=object
+        )
+
+    if not keys:
+        return pd.DataFrame(
+            {output: [cells[output].sum()] for output in outputs},
+            index=pd.Index(["all"], name="total"),
+        )
+
+    return cells.groupby(keys)[outputs].sum()
+
+
+def compute_tables(
+    stats: list[Stat],
+    run_table: Callable[[list[Reduction]], pd.DataFrame],
+    verbose: bool = True,
+    profiler: Optional[StageProfiler] = None,
+    stage_prefix: str = "aggregate",
+) -> dict[str, pd.DataFrame]:
+    """Compute every table the stats need, projecting all it can from the rollup cube
+
+    Given a profiler, each table is measured as a stage of its own.
+    """
+    plan = plan_aggregations(stats)
+    cube = ROLLUP_CUBE.table if ROLLUP_CUBE.table in plan else None
+
+    aggregates = {}
+    for name in sorted(plan, key=lambda name: name != cube):
+        reductions = plan[name]
+        t0 = time.time()
+        with profile_stage(profiler, f"{stage_prefix} {name}"):
+            if cube and name != cube and all(map(is_cube_projection, reductions)):
+                message = f"Projecting {name} from the rollup cube..."
+                aggregates[name] = project_cube(aggregates[cube], reductions)
+            else:
+                message = f"Aggregating by {name}..."
+                aggregates[name] = run_table(reductions)
+        if verbose:
+            print(message)
+            print(f"  Done in {time.time() - t0:.2f}s")
+
+    return aggregates
+
+
+def hash_keys(keys: pd.Index) -> np.ndarray:
+    """Stable 64 bit hashes of group keys, equal across runs and months"""
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def mix_hash(hashes: np.ndarray, seed: int) -> np.ndarray:
+    """splitmix64 finalizer, giving each Count-Min row an independent hash"""
+    x = hashes + np.uint64((seed * 0x9E3779B97F4A7C15) % 2**64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def build_count_min(counts: pd.Series) -> pd.DataFrame:
+    """Count-Min sketch of counts, as a sparse table of (row, bucket) cell counts
+
+    Cells add up, so sketches of different chunks and months merge like any
+    other aggregate table.
+    """
+    hashes = hash_keys(counts.index)
+    weights = counts.to_numpy(dtype=np.float64)
+    rows = []
+    for row in range(COUNT_MIN_DEPTH):
+        buckets = mix_hash(hashes, row) % np.uint64(COUNT_MIN_WIDTH)
+        cells = np.bincount(buckets.astype(np.intp), weights, minlength=COUNT_MIN_WIDTH)
+        occupied = np.flatnonzero(cells)
+        rows.append(
+            pd.DataFrame(
+                {
+                    "row": row,
+                    "bucket": occupied,
+                    "ride_count": cells[occupied].astype(np.int64),
+                }
+            )
+        )
+
+    return pd.concat(rows).set_index(["row", "bucket"])
+
+
+def estimate_count_min(sketch: pd.DataFrame, keys: pd.Index) -> np.ndarray:
+    """Upper bound on the count of every key: the smallest of its cells"""
+    hashes = hash_keys(keys)
+    cells = sketch["ride_count"]
+    estimates = []
+    for row in range(COUNT_MIN_DEPTH):
+        buckets = mix_hash(hashes, row) % np.uint64(COUNT_MIN_WIDTH)
+        index = pd.MultiIndex.from_arrays(
+            [np.full(len(keys), row), buckets.astype(np.int64)]
+        )
+        estimates.append(cells.reindex(index).fillna(0).to_numpy(dtype=np.int64))
+
+    return np.min(estimates, axis=0)
+
+
+def build_space_saving(counts: pd.Series) -> pd.DataFrame:
+    """Space-Saving summary of exact counts: the heaviest keys, without error"""
+    top = sort_counts(counts).head(HEAVY_HITTER_CAPACITY)
+    return pd.DataFrame(
+        {"ride_count": top, "ride_count_error": np.zeros(len(top), dtype=np.int64)}
+    )
+
+
+def space_saving_floor(summary: pd.DataFrame) -> int:
+    """Upper bound on the count of any key a summary does not hold"""
+    if len(summary) < HEAVY_HITTER_CAPACITY:
+        return 0
+    return int(summary["ride_count"].min())
+
+
+def merge_space_saving(summaries: list[pd.DataFrame]) -> pd.DataFrame:
+    """Merge Space-Saving summaries, keeping the heaviest keys of the union
+
+    A key missing from a full summary may still have up to that summary's floor
+    trips, so the floor is added to both its count and its error.
+    """
+    merged = summaries[0]
+    for summary in summaries[1:]:
+        merged_floor, summary_floor = space_saving_floor(merged), space_saving_floor(summary)
+        left, right = merged.align(summary, join="outer")
+        merged = (left.fillna(merged_floor) + right.fillna(summary_floor)).astype(np.int64)
+        merged = merged.loc[
+            sort_counts(merged["ride_count"]).head(HEAVY_HITTER_CAPACITY).index
+        ]
+
+    return merged
+
+
+def run_reductions(df: pd.DataFrame, reductions: list[Reduction]) -> pd.DataFrame:
+    """Compute every reduction sharing one grouping with a single groupby"""
+    keys, where = reductions[0].keys, reductions[0].where
+
+    # A sketch or cube is the only reduction in its table
+    if reductions[0].func == "cube":
+        return build_cube(df[df[where]] if where else df, keys)
+    if reductions[0].func == "space_saving":
+        return build_space_saving(count_by_codes(df, keys, where))
+    if reductions[0].func == "count_min":
+        return build_count_min(count_by_codes(df, keys, where))
+
+    # Plain counts over coded keys never need a groupby
+    if (
+        keys
+        and all(reduction.func == "size" for reduction in reductions)
+        and all(has_key_codes(df[key]) for key in keys)
+    ):
+        counts = count_by_codes(df, keys, where)
+        return pd.DataFrame({reduction.output: counts for reduction in reductions})
+
+    if where:
+        df = df[df[where]]
+
+    if not keys:
+        return pd.DataFrame(
+            {
+                reduction.output: [
+                    len(df)
+                    if reduction.func == "size"
+                    else df[reduction.column].agg(reduction.func)
+                ]
+                for reduction in reductions
+            },
+            index=pd.Index(["all"], name="total"),
+        )
+
+    grouped = df.groupby(list(keys), observed=True)
+    table = pd.DataFrame(
+        {
+            reduction.output: grouped.size()
+            if reduction.func == "size"
+            else grouped[reduction.column].agg(reduction.func)
+            for reduction in reductions
+        }
+    )
+    # Categorical keys are stored as plain strings so tables merge across months
+    if isinstance(table.index, pd.MultiIndex):
+        table.index = table.index.set_levels(
+            [
+                level.astype(str) if isinstance(level, pd.CategoricalIndex) else level
+                for level in table.index.levels
+            ]
+        )
+    elif isinstance(table.index, pd.CategoricalIndex):
+        table.index = table.index.astype(str)
+
+    return table
+
+
+def compute_month_aggregates(
+    df: pd.DataFrame,
+    stats: list[Stat] = STATS,
+    profiler: Optional[StageProfiler] = None,
+) -> dict[str, pd.DataFrame]:
+    return compute_tables(stats, functools.partial(run_reductions, df), profiler=profiler)
+
+
+def merge_aggregates(
+    month_aggregates: list[dict[str, pd.DataFrame]],
+) -> dict[str, pd.DataFrame]:
+    merged = {}
+    for name in month_aggregates[0]:
+        tables = [aggregates[name] for aggregates in month_aggregates]
+        if len(tables) == 1:
+            merged[name] = tables[0]
+            continue
+
+        if name.endswith(".space_saving"):
+            merged[name] = merge_space_saving(tables)
+            continue
+
+        combined = pd.concat(tables)
+        merged[name] = combined.groupby(
+            level=list(range(combined.index.nlevels))
+        ).sum()
+
+    return merged
+
+
+def stream_month_aggregates(
+    month: str,
+    shapefile_fp: Path,
+    grid_precision: int = NEIGHBORHOOD_GRID_PRECISION,
+    stats: list[Stat] = STREAMING_STATS,
+) -> dict[str, pd.DataFrame]:
+    """Aggregate a month one stored chunk at a time, merging as it goes
+
+    Only one chunk of trips is ever in memory; stats over unbounded groupings
+    must use sketches so the running aggregates stay bounded too.
+    """
+    aggregates = None
+    for i, chunk in enumerate(iter_trips_from_store(month, columns=ANALYSIS_COLUMNS)):
+        print(f"Processing chunk {i} of trips ({len(chunk)} rows)...")
+        chunk = enrich_trips(chunk, shapefile_fp, grid_precision)
+        chunk_aggregates = compute_tables(
+            stats, functools.partial(run_reductions, chunk), verbose=False
+        )
+        aggregates = (
+            chunk_aggregates
+            if aggregates is None
+            else merge_aggregates([aggregates, chunk_aggregates])
+        )
+
+    if aggregates is None:
+        raise Exception(f"No trips stored for month {month}")
+
+    return aggregates
+
+
+def sql_bins(column: str, edges: list[int], labels: list[str]) -> str:
+    """SQL for the label of the searchsorted bucket of a value, labels[0] below every edge"""
+    if not edges:
+        return labels[0]
+
+    cases = " ".join(
+        f"WHEN {column} >= {edge} THEN {labels[i + 1]}"
+        for i, edge in reversed(list(enumerate(edges)))
+    )
+    return f"CASE {cases} ELSE {labels[0]} END"
+
+
+def sql_distribution_features(
+    column: str, edges: list[int], where: Optional[str] = None
+) -> str:
+    """SQL for the columns quantile_buckets and histogram_bins derive from a value
+
+    Rows not matching where, if given, get neither a bucket nor a bin.
+    """
+    # Parsed from its repr, the divisor is the exact double numpy divides by
+    log_gamma = repr(float(np.log(QUANTILE_GAMMA)))
+    value = f"(CASE WHEN {where} THEN {column} END)" if where else column
+    return f"""
+        CASE
+            WHEN {value} IS NULL THEN NULL
+            WHEN {value} <= 0 THEN {ZERO_BUCKET}
+            ELSE CAST(ceil(ln({value}) / CAST('{log_gamma}' AS DOUBLE)) AS BIGINT)
+        END AS {column}_bucket,
+        CASE WHEN {value} IS NULL THEN NULL ELSE {
+            sql_bins(value, edges, ["0", *map(str, range(len(edges)))])
+        } END AS {column}_bin"""
+
+
+def sql_day_slot(column: str) -> str:
+    return (
+        f"CAST((hour({column}) * 60 + minute({column})) "
+        f"// {STATION_FLOW_SLOT_MINUTES} AS SMALLINT)"
+    )
+
+
+def trip_features_sql(schedules: list[FeeSchedule] = FEE_SCHEDULES) -> str:
+    """The features enrich_trips derives, materialized once from the stored trips
+
+    Every expression mirrors its pandas counterpart operation for operation, so
+    both engines compute the same floats and round revenue the same way.
+    """
+    fee_schedule = sql_bins(
+        "year(started_at) * 100 + month(started_at)",
+        [schedule.effective_from for schedule in schedules[1:]],
+        list(map(str, range(len(schedules)))),
+    )
+    undocked_fees = ", ".join(str(schedule.undocked_fee) for schedule in schedules)
+    time_of_day = "CASE WHEN hour IS NULL THEN NULL ELSE {} END".format(
+        sql_bins(
+            "hour",
+            TIME_OF_DAY_EDGES,
+            [f"'{TIME_OF_DAYS[bucket]}'" for bucket in TIME_OF_DAY_BUCKETS],
+        )
+    )
+    return f"""
+    CREATE TEMP TABLE features AS
+    WITH timed AS (
+        SELECT
+            * REPLACE (
+                CAST(rideable_type AS VARCHAR) AS rideable_type,
+                CAST(member_casual AS VARCHAR) AS member_casual,
+                CAST(start_neighborhood AS VARCHAR) AS start_neighborhood,
+                CAST(end_neighborhood AS VARCHAR) AS end_neighborhood
+            ),
+            CAST(epoch_ms(ended_at) - epoch_ms(started_at) AS DOUBLE) AS ride_duration_ms,
+            hour(started_at) AS hour,
+            isodow(started_at) - 1 AS weekday,
+            {sql_day_slot("started_at")} AS start_slot,
+            {sql_day_slot("ended_at")} AS end_slot,
+            {fee_schedule} AS fee_schedule
+        FROM trips
+    ), priced AS (
+        SELECT
+            timed.*,
+            ride_duration_ms / 60000 AS ride_duration,
+            {time_of_day} AS time_of_day,
+            round_even(
+                COALESCE(fees.unlock, 0)
+                + COALESCE(fees.per_minute, 0) * CASE
+                    WHEN ride_duration_ms IS NULL THEN NULL
+                    ELSE greatest(ride_duration_ms / 60000 - COALESCE(fees.included, 0), 0)
+                END
+                + CASE
+                    WHEN end_station_name IS NULL THEN [{undocked_fees}][fee_schedule + 1]
+                    ELSE 0
+                END,
+                0
+            ) AS revenue_cents,
+            (
+                start_station_name IS NULL
+                OR end_station_name IS NULL
+                OR start_station_name <> end_station_name
+            ) AS non_round_trip,
+            CAST(
+                CASE
+                    WHEN ride_duration_ms > 0
+                    THEN CAST(distance_m AS DOUBLE) * 3600 / ride_duration_ms
+                END AS REAL
+            ) AS speed_kmh
+        FROM timed
+        LEFT JOIN fees USING (fee_schedule, member_casual, rideable_type)
+    ), flagged AS (
+        SELECT
+            priced.*,
+            (
+                COALESCE(
+                    distance_m = 0
+                    AND ride_duration_ms > {IMPLAUSIBLE_STATIONARY_MINUTES * 60_000},
+                    false
+                )
+                OR COALESCE(speed_kmh > {IMPLAUSIBLE_SPEED_KMH}, false)
+            ) AS implausible_trip
+        FROM priced
+    )
+    SELECT
+        *,
+        {sql_distribution_features("ride_duration", DURATION_HISTOGRAM_EDGES)},
+        {sql_distribution_features("revenue_cents", REVENUE_HISTOGRAM_EDGES)},
+        {sql_distribution_features(
+            "distance_m", DISTANCE_HISTOGRAM_EDGES, where="NOT implausible_trip"
+        )},
+        {sql_distribution_features(
+            "speed_kmh", SPEED_HISTOGRAM_EDGES, where="NOT implausible_trip"
+        )}
+    FROM flagged
+    """
+
+
+def reduction_sql(reduction: Reduction, column_types: dict[str, str]) -> str:
+    if reduction.func == "size":
+        return "COUNT(*)"
+    if reduction.func == "count":
+        return f"COUNT({reduction.column})"
+    if reduction.func == "sum":
+        # Booleans sum to a count, and empty sums are 0, as in pandas
+        if column_types[reduction.column] == "BOOLEAN":
+            return f"CAST(count_if({reduction.column}) AS BIGINT)"
+        return f"COALESCE(SUM({reduction.column}), 0)"
+
+    raise ValueError(f"The SQL engine cannot compute '{reduction.func}' reductions")
+
+
+def run_cube_sql(con: Any, keys: list[str], column_types: dict[str, str]) -> pd.DataFrame:
+    """The rollup cube in one GROUP BY, keeping rows missing a key under MISSING_KEY"""
+    columns = [
+        f"COALESCE({key}, '{MISSING_KEY}') AS {key}"
+        if column_types[key] == "VARCHAR"
+        else f"COALESCE({key}, {MISSING_INT_KEY}) AS {key}"
+        for key in keys
+    ]
+    measures = ["COUNT(*) AS ride_count"] + [
+        f"COALESCE(SUM({measure}), 0) AS {measure}_sum, COUNT({measure}) AS {measure}_count"
+        for measure in ROLLUP_CUBE_MEASURES
+    ]
+    table = con.execute(
+        f"SELECT {', '.join(columns + measures)} FROM features "
+        f"GROUP BY ALL ORDER BY {', '.join(keys)}"
+    ).df()
+    return table.set_index(keys)
+
+
+def run_reductions_sql(
+    con: Any, reductions: list[Reduction], column_types: dict[str, str]
+) -> pd.DataFrame:
+    """Compute every reduction sharing one grouping with a single GROUP BY"""
+    keys, where = list(reductions[0].keys), reductions[0].where
+    if reductions[0].func == "cube":
+        return run_cube_sql(con, keys, column_types)
+
+    outputs = [
+        f"{reduction_sql(reduction, column_types)} AS {reduction.output}"
+        for reduction in reductions
+    ]
+    # Like groupby, rows with a missing key are dropped
+    conditions = [f"{key} IS NOT NULL" for key in keys] + ([where] if where else [])
+
+    sql = f"SELECT {', '.join(keys + outputs)} FROM features"
+    if conditions:
+        sql += f" WHERE {' AND '.join(conditions)}"
+    if keys:
+        sql += f" GROUP BY {', '.join(keys)} ORDER BY {', '.join(keys)}"
+
+    table = con.execute(sql).df()
+    if not keys:
+        table.index = pd.Index(["all"], name="total")
+        return table
+
+    return table.set_index(keys)
+
+
+def compute_month_aggregates_sql(
+    month: str,
+    shapefile_fp: Path,
+    grid_precision: int = NEIGHBORHOOD_GRID_PRECISION,
+    stats: list[Stat] = STATS,
+    profiler: Optional[StageProfiler] = None,
+) -> dict[str, pd.DataFrame]:
+    """Compute a month's aggregates with DuckDB, straight off the memory-mapped store
+
+    Only the coordinate features (neighborhoods, density cells and distances)
+    are computed in pandas; every other feature and reduction is pushed down
+    into SQL. The tables match compute_month_aggregates exactly, so
+    the shared formatters publish byte-identical JSON. Given a profiler, the
+    neighborhood lookup, the features and each table are measured on their own.
+    """
+    import duckdb
+
+    table = feather.read_table(
+        get_month_store_path(month), columns=ANALYSIS_COLUMNS, memory_map=True
+    )
+
+    print("Assigning neighborhoods to trips...")
+    with profile_stage(profiler, "aggregate_sql neighborhoods"):
+        coordinates = get_neighborhoods(
+            table.select(["start_lat", "start_lng", "end_lat", "end_lng"]).to_pandas(),
+            shapefile_fp,
+            grid_precision,
+        )
+        for end in ("start", "end"):
+            table = table.append_column(
+                f"{end}_neighborhood", pa.array(coordinates[f"{end}_neighborhood"])
+            )
+            table = table.append_column(
+                f"{end}_cell", pa.array(coordinates[f"{end}_cell"])
+            )
+        # numpy and DuckDB trigonometry can differ in the last bit, so distances
+        # are computed once in pandas for both engines. DuckDB sorts NaN above
+        # every number, so trips missing an end get a null distance instead.
+        table = table.append_column(
+            "distance_m", pa.array(haversine_meters(coordinates), from_pandas=True)
+        )
+
+    fees = pd.DataFrame(
+        [
+            (i, membership, rideable_type, *rates)
+            for i, schedule in enumerate(FEE_SCHEDULES)
+            for (membership, rideable_type), rates in schedule.rates.items()
+        ],
+        columns=[
+            "fee_schedule",
+            "member_casual",
+            "rideable_type",
+            "unlock",
+            "included",
+            "per_minute",
+        ],
+    )
+
+    with duckdb.connect() as con:
+        con.register("trips", table)
+        con.register("fees", fees)
+        with profile_stage(profiler, "aggregate_sql features"):
+            con.execute(trip_features_sql())
+        column_types = {
+            name: column_type
+            for name, column_type, *_ in con.execute("DESCRIBE features").fetchall()
+        }
+
+        aggregates = compute_tables(
+            stats,
+            functools.partial(run_reductions_sql, con, column_types=column_types),
+            profiler=profiler,
+            stage_prefix="aggregate_sql",
+        )
+
+    return aggregates
+
+
+def format_month_range(months: list[str]) -> str:
+    first, last = (
+        datetime.strptime(month, "%Y%m").strftime("%b %Y")
+        for month in (months[0], months[-1])
+    )
+    return last if first == last else f"{first} - {last}"
+
+
+def get_output_variants(fp: Path) -> list[Path]:
+    """A published file and its precompressed variants"""
+    return [fp.with_name(f"{fp.name}{suffix}") for suffix in ("", ".gz", ".br")]
+
+
+def write_compressed_variants(fp: Path, content: bytes) -> None:
+    # mtime=0 keeps the gzip bytes identical for identical content
+    fp.with_name(f"{fp.name}.gz").write_bytes(
+        gzip.compress(content, compresslevel=9, mtime=0)
+    )
+    quality = BROTLI_QUALITY if len(content) < BROTLI_LARGE_BYTES else BROTLI_LARGE_QUALITY
+    fp.with_name(f"{fp.name}.br").write_bytes(brotli.compress(content, quality=quality))
+
+
+def write_output_file(fp: Path, content: bytes) -> None:
+    """Write a file and its variants, unless the same content is already on disk"""
+    if all(variant.is_file() for variant in get_output_variants(fp)):
+        if fp.read_bytes() == content:
+            return
+
+    fp.write_bytes(content)
+    write_compressed_variants(fp, content)
+
+
+def write_stats_section(name: str, value: Any) -> str:
+    """Write a section under a content-hashed name and return its URL"""
+    content = json.dumps(value, separators=(",", ":")).encode()
+    digest = hashlib.sha256(content).hexdigest()[:12]
+
+    fp = STATS_SECTION_DIR / f"{name}.{digest}.json"
+    write_output_file(fp, content)
+
+    return f"/{STATS_SECTION_DIR.as_posix()}/{fp.name}"
+
+
+def write_stats_output(result: dict, outfile: Optional[Path] = None) -> Path:
+    """Write the manifest, with the heavy sections split into their own files
+
+    Section files never change once written, so they can be cached forever;
+    only the small manifest has to be revalidated.
+    """
+    STATS_SECTION_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = {"meta": result["meta"], "stats": {}, "sections": {}}
+    for name, value in result["stats"].items():
+        if name in SPLIT_SECTIONS:
+            manifest["sections"][name] = write_stats_section(name, value)
+        else:
+            manifest["stats"][name] = value
+
+    # Drop sections (and their variants) no longer referenced by the manifest
+    referenced = {Path(url).name for url in manifest["sections"].values()}
+    for fp in STATS_SECTION_DIR.iterdir():
+        if fp.name.removesuffix(".gz").removesuffix(".br") not in referenced:
+            fp.unlink()
+
+    outfile = Path(outfile or OUTFILE_NAME)
+    print(f"Writing output to {outfile}...")
+    write_output_file(outfile, json.dumps(manifest).encode())
     return outfile
 
 
-def main() -> None:
-    print("Finding most recent Divvy data file...")
-    filename = get_most_recent_filename()
-    if not filename:
-        raise Exception("Could not find most recent filename")
+class StaleCheckpoint(Exception):
+    """A checkpoint refers to files that were since changed or removed"""
 
-    print(f"Most recent filename: '{filename}'")
 
-    date_section, *_ = filename.split("-", maxsplit=1)
-    file_date = datetime.strptime(date_section, "%Y%m")
+@dataclass(frozen=True)
+class Stage:
+    """A declared pipeline step
+
+    run takes the outputs of the task's dependencies and the task's params as
+    keyword arguments. Outputs of stages with a save/load pair are checkpointed;
+    load raises StaleCheckpoint (or FileNotFoundError) when the checkpoint can no
+    longer be trusted. Bump version whenever the stage's output would change.
+    """
+
+    name: str
+    version: int
+    run: Callable[..., Any]
+    save: Optional[Callable[[Any, Path], None]] = None
+    load: Optional[Callable[[Path], Any]] = None
+    rows: Optional[Callable[[Any, Optional[str]], int]] = None
+
+
+@dataclass(eq=False)
+class Task:
+    """A stage applied to params and the outputs of upstream tasks"""
+
+    stage: Stage
+    params: dict[str, Any] = field(default_factory=dict)
+    deps: dict[str, "Task"] = field(default_factory=dict)
+    month: Optional[str] = None
+
+    @functools.cached_property
+    def fingerprint(self) -> str:
+        """Hash of the stage's code version, the params and every upstream fingerprint
+
+        Path params are hashed by content, so a changed input file changes the
+        fingerprint of every task downstream of it.
+        """
+        payload = {
+            "stage": self.stage.name,
+            "version": self.stage.version,
+            "params": self.params,
+            "deps": {name: dep.fingerprint for name, dep in self.deps.items()},
+        }
+        content = json.dumps(payload, sort_keys=True, default=fingerprint_param)
+        return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+    @property
+    def label(self) -> str:
+        return f"{self.stage.name} {self.month}" if self.month else self.stage.name
+
+    @property
+    def checkpoint_dir(self) -> Path:
+        prefix = f"{self.month}." if self.month else ""
+        return CHECKPOINT_DIR / self.stage.name / f"{prefix}{self.fingerprint}"
+
+
+def fingerprint_param(value: Any) -> Any:
+    if isinstance(value, Path):
+        [sha256] = hash_file(value, "sha256")
+        return {"name": value.name, "sha256": sha256}
+    raise TypeError(f"Cannot fingerprint {type(value).__name__}")
+
+
+class Pipeline:
+    """Runs a DAG of tasks from the target back, skipping all work behind a checkpoint
+
+    A task whose checkpoint exists is loaded without looking at its dependencies,
+    so a rerun with nothing changed only loads the final stage's checkpoint.
+    Outputs are released as soon as their last consumer has them.
+    """
+
+    def __init__(self, profiler: Optional[StageProfiler] = None) -> None:
+        self.profiler = profiler or StageProfiler()
+        self.outputs: dict[str, Any] = {}
+        self.consumers: dict[str, int] = {}
+
+    def run(self, target: Task) -> Any:
+        self.outputs, self.consumers = {}, {target.fingerprint: 1}
+        for task in walk_tasks(target):
+            for dep in task.deps.values():
+                self.consumers[dep.fingerprint] = self.consumers.get(dep.fingerprint, 0) + 1
+
+        return self.get(target)
+
+    def get(self, task: Task) -> Any:
+        key = task.fingerprint
+        if key in self.outputs:
+            output = self.outputs[key]
+        else:
+            output = self.load(task)
+            if output is None:
+                output = self.execute(task)
+
+        self.consumers[key] -= 1
+        if self.consumers[key] > 0:
+            self.outputs[key] = output
+        else:
+            self.outputs.pop(key, None)
+        return output
+
+    def load(self, task: Task) -> Any:
+        checkpoint_dir = task.checkpoint_dir
+        if task.stage.load is None or not checkpoint_dir.is_dir():
+            return
+
+        try:
+            output = task.stage.load(checkpoint_dir)
+        except (StaleCheckpoint, FileNotFoundError) as e:
+            print(f"Discarding checkpoint of {task.label} ({e})")
+            shutil.rmtree(checkpoint_dir)
+            return
+
+        print(f"Using checkpoint of {task.label} ({task.fingerprint})")
+        return output
+
+    def execute(self, task: Task) -> Any:
+        inputs = {name: self.get(dep) for name, dep in task.deps.items()}
+        with self.profiler.stage(task.stage.name, task.month) as record:
+            output = task.stage.run(**inputs, **task.params)
+            del inputs
+            if task.stage.rows is not None:
+                record.rows = task.stage.rows(output, task.month)
+
+        if task.stage.save is not None:
+            save_checkpoint(task, output)
+        return output
+
+
+def walk_tasks(target: Task) -> list[Task]:
+    """Every distinct task in the graph behind target"""
+    tasks = {}
+    pending = [target]
+    while pending:
+        task = pending.pop()
+        if task.fingerprint not in tasks:
+            tasks[task.fingerprint] = task
+            pending.extend(task.deps.values())
+
+    return list(tasks.values())
 
-    print("Downloading monthly data file...")
-    fp = download_monthly_zipfile(filename)
-    if not fp:
-        raise Exception(f"Failed to download most recent datafile, '{filename}'")
 
-    print("Downloaded monthly data file")
+def save_checkpoint(task: Task, output: Any) -> Path:
+    checkpoint_dir = task.checkpoint_dir
+    tmp_dir = checkpoint_dir.with_name(f"{checkpoint_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    task.stage.save(output, tmp_dir)
 
-    print("Downloading neighborhood shapefile...")
-    shapefile_fp = download_neighborhood_shapefile()
+    # A month keeps one checkpoint per stage, and so does a stage with no month
+    # (the shapefile, render and write); drop those of earlier inputs
+    for stale_dir in checkpoint_dir.parent.glob(f"{task.month}.*" if task.month else "*"):
+        if stale_dir != tmp_dir:
+            shutil.rmtree(stale_dir)
+
+    tmp_dir.rename(checkpoint_dir)
+    return checkpoint_dir
+
+
+def save_json(value: Any, checkpoint_dir: Path) -> None:
+    (checkpoint_dir / "output.json").write_text(json.dumps(value))
+
+
+def load_json(checkpoint_dir: Path) -> Any:
+    return json.loads((checkpoint_dir / "output.json").read_text())
+
+
+def save_aggregates(aggregates: dict[str, pd.DataFrame], checkpoint_dir: Path) -> None:
+    for name, table in aggregates.items():
+        table.to_parquet(checkpoint_dir / f"{name}.parquet")
+
+
+def load_aggregates(checkpoint_dir: Path) -> dict[str, pd.DataFrame]:
+    return {fp.stem: pd.read_parquet(fp) for fp in sorted(checkpoint_dir.glob("*.parquet"))}
+
+
+def save_file_reference(fp: Path, checkpoint_dir: Path) -> None:
+    save_json({"path": str(fp), "files": get_file_hashes([fp])}, checkpoint_dir)
+
+
+def load_file_reference(checkpoint_dir: Path) -> Path:
+    """The referenced file, as long as it is unchanged since the checkpoint"""
+    reference = load_json(checkpoint_dir)
+    if get_file_hashes(reference["files"]) != reference["files"]:
+        raise StaleCheckpoint("referenced files changed")
+    return Path(reference["path"])
+
+
+def get_file_hashes(fps: Any) -> dict[str, str]:
+    return {
+        str(fp): hash_file(Path(fp), "sha256")[0] if Path(fp).is_file() else ""
+        for fp in fps
+    }
+
+
+def get_output_files(outfile: Path) -> list[Path]:
+    """The manifest, its sections and their compressed variants"""
+    manifest = json.loads(outfile.read_text())
+    fps = [outfile] + [Path(url.lstrip("/")) for url in manifest["sections"].values()]
+    return [variant for fp in fps for variant in get_output_variants(fp)]
+
+
+def save_output_reference(outfile: Path, checkpoint_dir: Path) -> None:
+    save_json(
+        {"path": str(outfile), "files": get_file_hashes(get_output_files(outfile))},
+        checkpoint_dir,
+    )
+
+
+def extract_shapefile(zip_fp: Path) -> Path:
+    shapefile_fp = extract_neighborhood_shapefile(zip_fp)
     if not shapefile_fp:
-        raise Exception(
-            f"Failed to download neighboorhood shapefile map, '{NEIGHBORHOOD_SHAPEFILE_LINK}'"
-        )
+        raise Exception(f"Failed to extract neighborhood shapefile map, '{zip_fp}'")
+    return shapefile_fp
 
-    print("Loading data into SQLite...")
-    conn = sqlite3.connect(f"divvy_data_{date_section}.db")
-    load_csv_files_to_sqlite(conn, fp)
 
-    print("Data loaded to sqlite")
+def download_month(name: str, etag: str, bucket_url: str) -> Path:
+    print(f"Downloading '{name}'...")
+    fp = download_monthly_zipfile(name, etag, bucket_url)
+    if not fp:
+        raise Exception(f"Failed to download datafile, '{name}'")
+    return fp
 
-    print("Generating analysis JSON...")
-    generate_analysis_json(conn, file_date.strftime("%b %Y"), shapefile_fp)
 
-    print("Analysis generated")
+def ingest_month(zip_fp: Path, month: str, etag: str) -> str:
+    print("Writing data to the trip store...")
+    ingest_zipfile_to_trip_store(zip_fp, month, etag)
+    return month
+
+
+def save_stored_month(month: str, checkpoint_dir: Path) -> None:
+    save_json({"month": month, "etag": get_stored_month_etag(month)}, checkpoint_dir)
+
+
+def load_stored_month(checkpoint_dir: Path) -> str:
+    """The stored month, as long as the trip store still holds the same upload"""
+    stored = load_json(checkpoint_dir)
+    if get_stored_month_etag(stored["month"]) != stored["etag"]:
+        raise StaleCheckpoint(f"trip store no longer holds month {stored['month']}")
+    return stored["month"]
+
 
-    conn.close()
+def read_month(month: str) -> pd.DataFrame:
+    print("Reading trips from the trip store...")
+    return read_trips_from_store([month], columns=ANALYSIS_COLUMNS)
+
+
+def enrich_month(
+    df: pd.DataFrame, shapefile_fp: Path, grid_precision: int
+) -> pd.DataFrame:
+    print("Processing trip data...")
+    return enrich_trips(df, shapefile_fp, grid_precision)
+
+
+def aggregate_month(df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    return compute_month_aggregates(df, STATS)
+
+
+def merge_months(**month_aggregates: dict[str, pd.DataFrame]) -> dict[str, pd.DataFrame]:
+    return merge_aggregates([month_aggregates[key] for key in sorted(month_aggregates)])
+
+
+def render_stats(
+    aggregates: dict[str, pd.DataFrame],
+    shapefile_fp: Path,
+    months: list[str],
+    streaming: bool,
+) -> dict:
+    print("Formatting stats...")
+    result = {
+        "meta": {"as_of": format_month_range(months), "months": months},
+        "stats": {},
+    }
+    for stat in STREAMING_STATS if streaming else STATS:
+        result["stats"][stat.name] = stat.format(aggregates)
+
+    result["stats"]["neighborhood_map"] = get_neighborhood_map(shapefile_fp)
+    return result
+
+
+def count_frame_rows(df: pd.DataFrame, month: Optional[str]) -> int:
+    return len(df)
+
+
+def count_stored_rows(output: Any, month: Optional[str]) -> int:
+    return get_stored_month_rows(month)
+
+
+SHAPEFILE_STAGE = Stage(
+    "shapefile", 1, extract_shapefile, save_file_reference, load_file_reference
+)
+DOWNLOAD_STAGE = Stage(
+    "download", 1, download_month, save_file_reference, load_file_reference
+)
+INGEST_STAGE = Stage(
+    "ingest", 1, ingest_month, save_stored_month, load_stored_month, count_stored_rows
+)
+READ_STAGE = Stage("read", 1, read_month, rows=count_frame_rows)
+# Not checkpointed: an enriched month is as large as its trips, and reruns only
+# need the aggregate checkpoint behind it
+ENRICH_STAGE = Stage("enrich", ENRICH_VERSION, enrich_month, rows=count_frame_rows)
+AGGREGATE_STAGE = Stage(
+    "aggregate",
+    AGGREGATE_VERSION,
+    aggregate_month,
+    save_aggregates,
+    load_aggregates,
+    count_stored_rows,
+)
+STREAM_STAGE = Stage(
+    "stream",
+    AGGREGATE_VERSION,
+    functools.partial(stream_month_aggregates, stats=STREAMING_STATS),
+    save_aggregates,
+    load_aggregates,
+    count_stored_rows,
+)
+AGGREGATE_SQL_STAGE = Stage(
+    "aggregate_sql",
+    AGGREGATE_VERSION,
+    functools.partial(compute_month_aggregates_sql, stats=STATS),
+    save_aggregates,
+    load_aggregates,
+    count_stored_rows,
+)
+MERGE_STAGE = Stage("merge", 1, merge_months)
+RENDER_STAGE = Stage("render", RENDER_VERSION, render_stats, save_json, load_json)
+WRITE_STAGE = Stage(
+    "write", RENDER_VERSION, write_stats_output, save_output_reference, load_file_reference
+)
+
+
+def plan_pipeline(
+    objects: dict[str, str],
+    keys: list[str],
+    outfile: Path,
+    grid_precision: int = NEIGHBORHOOD_GRID_PRECISION,
+    streaming: bool = False,
+    engine: str = "pandas",
+    bucket_url: str = DIVVY_BUCKET_URL,
+) -> Task:
+    """The task graph from the listed archives down to the written stats
+
+    Every month flows download -> ingest -> enrich -> aggregate (the streaming
+    and DuckDB engines aggregate straight from the trip store), and all months
+    merge into one render and write.
+    """
+    shapefile = Task(SHAPEFILE_STAGE, {"zip_fp": NEIGHBORHOOD_SHAPEFILE_ZIP})
+
+    month_aggregates = {}
+    for key in keys:
+        month, etag = get_month_from_key(key), objects[key]
+        download = Task(
+            DOWNLOAD_STAGE, {"name": key, "etag": etag, "bucket_url": bucket_url}, month=month
+        )
+        ingest = Task(INGEST_STAGE, {"month": month, "etag": etag}, {"zip_fp": download}, month)
+        if streaming or engine == "duckdb":
+            aggregate = Task(
+                STREAM_STAGE if streaming else AGGREGATE_SQL_STAGE,
+                {"grid_precision": grid_precision},
+                {"month": ingest, "shapefile_fp": shapefile},
+                month,
+            )
+        else:
+            read = Task(READ_STAGE, deps={"month": ingest}, month=month)
+            enrich = Task(
+                ENRICH_STAGE,
+                {"grid_precision": grid_precision},
+                {"df": read, "shapefile_fp": shapefile},
+                month,
+            )
+            aggregate = Task(AGGREGATE_STAGE, deps={"df": enrich}, month=month)
+        month_aggregates[key] = aggregate
+
+    merge = Task(MERGE_STAGE, deps=month_aggregates)
+    render = Task(
+        RENDER_STAGE,
+        {"months": [get_month_from_key(key) for key in keys], "streaming": streaming},
+        {"aggregates": merge, "shapefile_fp": shapefile},
+    )
+    return Task(WRITE_STAGE, {"outfile": str(outfile)}, {"result": render})
+
+
+def prune_month_cache(target: Task) -> None:
+    """Drop the bulky files of months outside the run, keeping their aggregates
+
+    Downloads and trip stores are only needed to recompute a month's
+    aggregates, which stay checkpointed for every month ever processed.
+    """
+    tasks = walk_tasks(target)
+    months = {task.month for task in tasks if task.month}
+    downloads = {
+        get_download_path(f"{task.params['bucket_url']}/{task.params['name']}").name
+        for task in tasks
+        if task.stage is DOWNLOAD_STAGE
+    }
+    pruned = set()
+    if DOWNLOAD_DIR.is_dir():
+        for fp in DOWNLOAD_DIR.iterdir():
+            # Sidecars and partial downloads share their download's name
+            if not any(fp.name.startswith(name) for name in downloads):
+                fp.unlink()
+                pruned.add(fp.name)
+
+    if TRIP_STORE_DIR.is_dir():
+        for month_dir in TRIP_STORE_DIR.glob("month=*"):
+            month = month_dir.name.removeprefix("month=")
+            if month not in months:
+                shutil.rmtree(month_dir)
+                pruned.add(month_dir.name)
+
+    for stage in (DOWNLOAD_STAGE, INGEST_STAGE):
+        for checkpoint_dir in (CHECKPOINT_DIR / stage.name).glob("*.*"):
+            if checkpoint_dir.name.split(".", 1)[0] not in months:
+                shutil.rmtree(checkpoint_dir)
+
+    # Enriched frames are no longer checkpointed; drop any left by earlier runs
+    shutil.rmtree(CHECKPOINT_DIR / ENRICH_STAGE.name, ignore_errors=True)
+    if pruned:
+        print(f"Pruned {len(pruned)} downloads and trip stores of earlier months")
+
+
+def limit_worker_memory(memory_mb: Optional[int]) -> None:
+    """Cap a worker's heap, so a month that outgrows it fails on its own"""
+    if memory_mb:
+        limit = memory_mb * 2**20
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def run_month_task(task: Task) -> list[StageRecord]:
+    profiler = StageProfiler()
+    Pipeline(profiler).run(task)
+    return profiler.records
+
+
+def backfill_months(
+    target: Task,
+    workers: int,
+    worker_memory_mb: Optional[int] = None,
+    profiler: Optional[StageProfiler] = None,
+) -> None:
+    """Checkpoint every month's aggregates in parallel, one month per worker
+
+    Shared tasks, like the shapefile, are run first so that workers only load
+    them. Running target afterwards then just merges the month checkpoints.
+    """
+    profiler = profiler or StageProfiler()
+    tasks = walk_tasks(target)
+    for task in tasks:
+        if task.stage is SHAPEFILE_STAGE:
+            Pipeline(profiler).run(task)
+
+    months = [
+        task
+        for task in tasks
+        if task.stage in (AGGREGATE_STAGE, STREAM_STAGE, AGGREGATE_SQL_STAGE)
+        and not task.checkpoint_dir.is_dir()
+    ]
+    if not months:
+        return
+
+    print(f"Backfilling {len(months)} months with {workers} workers...")
+    with ProcessPoolExecutor(
+        min(workers, len(months)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=limit_worker_memory,
+        initargs=(worker_memory_mb,),
+    ) as pool:
+        futures = {pool.submit(run_month_task, task): task for task in months}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                profiler.records.extend(future.result())
+            except Exception as e:
+                pool.shutdown(cancel_futures=True)
+                # Running out of memory surfaces as whatever the allocating
+                # library raises, not necessarily MemoryError
+                limit = f" (worker memory limit {worker_memory_mb} MB)" if worker_memory_mb else ""
+                raise Exception(f"Failed to backfill {task.label}{limit}") from e
+            print(f"Finished {task.label}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Build divvy-stats.json from the Divvy trip data bucket"
+    )
+    parser.add_argument(
+        "--months",
+        type=int,
+        default=1,
+        help="number of most recent months to merge into the published stats",
+    )
+    parser.add_argument(
+        "--grid-precision",
+        type=int,
+        default=NEIGHBORHOOD_GRID_PRECISION,
+        help="decimal places of the grid cells neighborhoods are resolved on",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="aggregate months chunk by chunk in bounded memory, approximating "
+        "popular routes with mergeable sketches",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["pandas", "duckdb"],
+        default="pandas",
+        help="compute month aggregates in pandas or push them down into DuckDB SQL",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        default=PROFILE_FP,
+        help="where to write the per-stage profile of this run",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="trace Python allocations per stage with tracemalloc (slow)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        choices=PROFILE_STAGES,
+        help="run one stage under cProfile and report its heaviest calls",
+    )
+    parser.add_argument(
+        "--bucket-url",
+        default=DIVVY_BUCKET_URL,
+        help="S3 endpoint of the trip archives, e.g. a local stand-in for testing",
+    )
+    parser.add_argument(
+        "--refresh-manifest",
+        action="store_true",
+        help="relist the whole bucket instead of only the published months and newer keys",
+    )
+    parser.add_argument(
+        "--backfill",
+        nargs=2,
+        metavar=("FROM", "TO"),
+        help="merge every month from FROM to TO (YYYYMM, inclusive) instead of "
+        "the most recent --months",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes to compute months in parallel; more than one runs each "
+        "month's download, ingest and aggregation in its own worker",
+    )
+    parser.add_argument(
+        "--worker-memory-mb",
+        type=int,
+        help="heap limit of each parallel worker",
+    )
+    args = parser.parse_args()
+    if args.streaming and args.engine != "pandas":
+        parser.error("--streaming is only supported by the pandas engine")
+
+    if args.trace_allocations:
+        tracemalloc.start()
+    profiler = StageProfiler(args.cprofile)
+    bucket_url = args.bucket_url.rstrip("/")
+
+    # Revalidate the months this run is about to publish; a new month only
+    # widens the relisted range by one key
+    if args.backfill:
+        first_month = args.backfill[0]
+    else:
+        window = sorted(load_bucket_manifest(bucket_url))[-args.months:]
+        first_month = get_month_from_key(window[0]) if window else None
+
+    print("Listing Divvy data files...")
+    with profiler.stage("list"):
+        objects = list_bucket_objects(bucket_url, args.refresh_manifest, first_month)
+    if args.backfill:
+        first, last = args.backfill
+        keys = [key for key in sorted(objects) if first <= get_month_from_key(key) <= last]
+    else:
+        keys = sorted(objects)[-args.months:]
+    if not keys:
+        raise Exception("Could not find any Divvy data files")
+
+    print(f"Most recent filename: '{keys[-1]}'")
+
+    target = plan_pipeline(
+        objects,
+        keys,
+        Path(OUTFILE_NAME),
+        args.grid_precision,
+        args.streaming,
+        args.engine,
+        bucket_url,
+    )
+    if args.workers > 1:
+        backfill_months(target, args.workers, args.worker_memory_mb, profiler)
+    outfile = Pipeline(profiler).run(target)
+    print(f"Stats written to {outfile}")
+    prune_month_cache(target)
+
+    print("Analysis generated")
+    profiler.print_summary()
+    # A rerun that only loaded checkpoints would replace the committed profile
+    # of the last real run with one of just the listing
+    if any(record.name != "list" for record in profiler.records):
+        print(f"Profile written to {profiler.write(args.profile)}")
+    else:
+        print(f"Nothing recomputed, keeping the profile in {args.profile}")
+    profiler.write_cprofile()
     print("Done.")
 
 